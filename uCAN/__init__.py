@@ -1,2 +1,5 @@
 from bus import NodeAddress, Bus
 from messages import HardwareId
+from nameserver import NameServer
+from gateway import Gateway
+from scheduler import PollScheduler
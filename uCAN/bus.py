@@ -1,7 +1,9 @@
 import can.message
 from can.interfaces import socketcan_ctypes
-import time
-from uCAN.messages import HardwareId, Message, UnicastMessage, YARPMessage, RAPMessage
+from uCAN import state
+from uCAN.clock import monotonic
+from uCAN.messages import HardwareId, Message, UnicastMessage, YARPMessage, RAPMessage, BTPMessage, TelemetryMessage
+from uCAN.tracing import NULL_SPAN
 
 
 class NodeAddress(object):
@@ -10,16 +12,27 @@ class NodeAddress(object):
         self.node_id = node_id
 
 
+class _IncomingTransfer(object):
+    """Reassembly state for a BTP transfer being received from a remote node."""
+    def __init__(self, length):
+        self.buffer = bytearray(length)
+        self.view = memoryview(self.buffer)
+        self.frames = (length + BTPMessage.FRAME_SIZE - 1) // BTPMessage.FRAME_SIZE
+        self.next_frame = 0
+        self.block_remaining = 0
+        self.nak_sent = False
+
+
 def _encodeMessage(message):
     return can.message.Message(
         arbitration_id=message.encodeHeader().uint,
-        data=message.encodeBody().bytes)
+        data=message.encodeData())
 
 
 class Bus(object):
     handlers = {}
 
-    def __init__(self, bus, hardware_id):
+    def __init__(self, bus, hardware_id, state_path=None):
         if isinstance(bus, basestring):
             bus = socketcan_ctypes.Bus(bus)
         self.bus = bus
@@ -28,20 +41,69 @@ class Bus(object):
         self.on_new_node_id = None
         self.timeout = 1.0
         self.promiscuous = False
+        # Functions called with every decoded message, including ones not addressed to us
+        self.observers = [self._learnNode]
+        # A uCAN.tracing.Tracer to record timings to, or None
+        self.tracer = None
+        # Clock used by message handlers, which can't take a now argument
+        self.now = monotonic
+
+        # Node ID and node table persistence, for fast restarts
+        self.state_path = state_path
+        self.warm_start_timeout = 0.1
+        # How long to wait for a known node to confirm its node ID before asking the whole bus
+        self.known_node_timeout = 0.1
+        self.known_nodes = {}
+        if state_path:
+            saved = state.load(state_path)
+            for hardware_id, node_id in saved.get('nodes', {}).items():
+                self.known_nodes[HardwareId(hardware_id)] = node_id
 
         # RAP variables
         self.register_map = {}
-
-    def start(self, default_node_id=None, now=time.time):
+        # How long read responses may be served from the cache, or None to disable caching
+        self.rap_cache_ttl = None
+        self.rap_cache = {}
+        # Requests per second allowed from each sender, or None to disable rate limiting
+        self.rap_rate = None
+        self.rap_burst = 10
+        self.rap_buckets = {}
+
+        # BTP variables
+        self.bulk_block_size = BTPMessage.MAX_BLOCK_SIZE
+        self.bulk_retries = 3
+        # Largest transfer we'll allocate a buffer for; larger ones are aborted
+        self.bulk_max_length = 1024 * 1024
+        # Most buffer space held for incoming transfers at once, including completed ones not yet received
+        self.bulk_max_total = 4 * 1024 * 1024
+        self.bulk_transfers = {}
+        # (sender, payload) tuples for completed transfers waiting for receiveTransfer
+        self.bulk_completed = []
+
+        # Telemetry variables
+        self.publish_min_interval = 0.01
+        self.publish_max_interval = 1.0
+        self.published = {}
+        self.telemetry = {}
+        self.subscribers = []
+
+    def start(self, default_node_id=None, now=monotonic):
         if not default_node_id:
             default_node_id = ord(self.hardware_id.hwid[-1])
         default_node_id &= 0x7F
 
         self.node_id = 0xFF
+        # If we had a node ID last time we ran, take it back as long as nobody else has it
+        saved_node_id = self.state_path and state.load(self.state_path).get('node_id')
+        if saved_node_id is not None and \
+           not self.ping(NodeAddress(self, saved_node_id), now=now, timeout=self.warm_start_timeout):
+            self.node_id = saved_node_id
+
         # See if there's a nameserver out there to assign us a node ID
-        node = self.getNodeFromHardwareId(self.hardware_id, now=now)
-        if node:
-            self.node_id = node.node_id
+        if self.node_id == 0xFF:
+            node = self.getNodeFromHardwareId(self.hardware_id, now=now)
+            if node:
+                self.node_id = node.node_id
 
         # If we weren't assigned one, ping nodes until we find a free ID
         while self.node_id == 0xFF:
@@ -49,27 +111,57 @@ class Bus(object):
                 self.node_id = default_node_id
             else:
                 default_node_id = (default_node_id + 1) & 0x7F
+        self.saveState()
+
+    def saveState(self):
+        """Writes our node ID and the table of known nodes to state_path, if one was given.
+
+        This happens automatically at the end of start() and when our address changes; call it explicitly to
+        persist nodes learned since then.
+        """
+        if not self.state_path:
+            return
+        state.save(self.state_path, {
+            'node_id': None if self.node_id == 0xFF else self.node_id,
+            'nodes': dict((str(k), v) for k, v in self.known_nodes.items()),
+        })
+
+    def _span(self, name, **args):
+        if self.tracer is None:
+            return NULL_SPAN
+        return self.tracer.span(name, **args)
 
     def send(self, message):
-        self.bus.send(_encodeMessage(message))
+        with self._span('send'):
+            self.bus.send(_encodeMessage(message))
 
     def _handleMessage(self, message):
-        return Bus.handlers.get(type(message), lambda self, message: False)(self, message)
+        with self._span('dispatch'):
+            return self.handlers.get(type(message), lambda self, message: False)(self, message)
 
     def _tryReceive(self, timeout=None):
-        message = self.bus.recv(timeout)
+        with self._span('recv'):
+            message = self.bus.recv(timeout)
         if not message:
             return None
+        received_at = self.now()
         if message.is_remote_frame or not message.id_type or message.is_error_frame:
             # Ignore these types of messages
             return None
 
-        message = Message.decode(message.arbitration_id, message.data)
+        with self._span('decode'):
+            message = Message.decode(message.arbitration_id, message.data, timestamp=message.timestamp)
+            message.received_at = received_at
 
-        # Ignore messages not addressed to us
-        if isinstance(message, UnicastMessage) and \
-           message.recipient != self.node_id and \
-           message.recipient != UnicastMessage.BROADCAST_RECIPIENT:
+        with self._span('filter'):
+            for observer in self.observers:
+                observer(message)
+
+            # Ignore messages not addressed to us
+            addressed = not isinstance(message, UnicastMessage) or \
+                message.recipient == self.node_id or \
+                message.recipient == UnicastMessage.BROADCAST_RECIPIENT
+        if not addressed:
             if self.promiscuous:
                 return message
             else:
@@ -77,14 +169,16 @@ class Bus(object):
 
         return None if self._handleMessage(message) else message
 
-    def _receiveUntil(self, filter, now=time.time):
+    def _receiveUntil(self, filter, now=monotonic, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
         start = now()
-        remaining = self.timeout
+        remaining = timeout
         while remaining > 0:
             message = self._tryReceive(remaining)
             if message and filter(message):
                 return message
-            remaining = self.timeout - (now() - start)
+            remaining = timeout - (now() - start)
         return None
 
     def receive(self):
@@ -94,10 +188,16 @@ class Bus(object):
         """Returns a NodeAddress instance for a given Node ID."""
         return NodeAddress(self, node_id)
 
-    def getNodeFromHardwareId(self, hardware_id, now=time.time):
+    def getNodeFromHardwareId(self, hardware_id, now=monotonic):
         """Returns a NodeAddress instance for a given Node ID, or None if the node is not found."""
-        # TODO: Implement hardware ID caching
         hardware_id = HardwareId(hardware_id)
+        if hardware_id in self.known_nodes:
+            # Check the node still has the ID we remember before trusting it
+            node = NodeAddress(self, self.known_nodes[hardware_id])
+            if self.ping(node, now=now, timeout=self.known_node_timeout) == hardware_id:
+                return node
+            del self.known_nodes[hardware_id]
+
         self.send(YARPMessage(
             sender=self.node_id,
             recipient=YARPMessage.BROADCAST_RECIPIENT,
@@ -135,6 +235,7 @@ class Bus(object):
                 # Addressed to someone else
                 return False
             self.node_id = message.new_node_id
+            self.saveState()
             self.onAddressChange(self.node_id)
     handlers[YARPMessage] = _handleYARP
 
@@ -142,11 +243,25 @@ class Bus(object):
         """Called when a node's address changes."""
         pass
 
-    def ping(self, node, now=time.time):
+    def _learnNode(self, message):
+        if not isinstance(message, YARPMessage) or not message.hardware_id or \
+           message.hardware_id == self.hardware_id:
+            return
+        if message.query and message.response:
+            node_id = message.sender
+        elif not message.query and not message.response:
+            node_id = message.new_node_id
+        else:
+            return
+        if node_id != UnicastMessage.BROADCAST_RECIPIENT and self.known_nodes.get(message.hardware_id) != node_id:
+            self.known_nodes[message.hardware_id] = node_id
+
+    def ping(self, node, now=monotonic, timeout=None):
         """Pings a node to check if it's up.
 
         Arguments:
             node: A Node object.
+            timeout: How long to wait for a reply, or None to use the bus timeout.
 
         Returns:
             A hardware address, if the node is found, or None if not.
@@ -160,7 +275,7 @@ class Bus(object):
         def is_reply(message):
             return (isinstance(message, YARPMessage) and message.sender == node.node_id and
                     message.query and message.response)
-        response = self._receiveUntil(is_reply, now=now)
+        response = self._receiveUntil(is_reply, now=now, timeout=timeout)
         return response and response.hardware_id
 
     def setAddress(self, hardware_id, node_id):
@@ -182,6 +297,9 @@ class Bus(object):
     def _handleRAP(self, message):
         if message.response:
             return False
+        if self.rap_rate is not None and not self._takeRAPToken(message.sender):
+            # Drop requests from senders over their rate limit
+            return True
 
         read_handler, write_handler = self.register_map.get(message.page, (None, None))
 
@@ -191,11 +309,29 @@ class Bus(object):
             self._handleRAPRead(message.sender, read_handler, message.page, message.register, message.size)
     handlers[RAPMessage] = _handleRAP
 
+    def _takeRAPToken(self, sender):
+        now = self.now()
+        tokens, last = self.rap_buckets.get(sender, (self.rap_burst, now))
+        tokens = min(self.rap_burst, tokens + (now - last) * self.rap_rate)
+        if tokens < 1:
+            self.rap_buckets[sender] = (tokens, now)
+            return False
+        self.rap_buckets[sender] = (tokens - 1, now)
+        return True
+
     def _handleRAPRead(self, sender, handler, page, register, size):
-        if handler:
-            data = [handler(self, page, (register + i) % 256) for i in range(size)]
+        key = (page, register, size)
+        cached = self.rap_cache.get(key) if self.rap_cache_ttl else None
+        if cached and self.now() - cached[1] < self.rap_cache_ttl:
+            data = cached[0]
         else:
-            data = ['\0'] * size
+            data = bytearray(size)
+            if handler:
+                with self._span('handler', handler=handler, page=page, register=register):
+                    for i in range(size):
+                        data[i] = handler(self, page, (register + i) % 256)
+            if self.rap_cache_ttl:
+                self.rap_cache[key] = (data, self.now())
 
         self.send(RAPMessage(
             sender=self.node_id,
@@ -209,9 +345,11 @@ class Bus(object):
     def _handleRAPWrite(self, sender, handler, page, register, data):
         if not handler:
             return
+        self.invalidateRegisters(page)
 
-        for i in range(len(data)):
-            handler(self, page, (register + i) % 256, data[i])
+        with self._span('handler', handler=handler, page=page, register=register):
+            for i in range(len(data)):
+                handler(self, page, (register + i) % 256, data[i])
 
     def configureRegisters(self, page, read_handler, write_handler):
         """Configures read and write handlers for a RAP register page.
@@ -226,8 +364,21 @@ class Bus(object):
             is a single character string.
         """
         self.register_map[page] = (read_handler, write_handler)
+        self.invalidateRegisters(page)
 
-    def readRegisters(self, node, page, register, length, now=time.time):
+    def invalidateRegisters(self, page=None):
+        """Discards cached read responses, for use when local register values change.
+
+        Arguments:
+          page: The page number to invalidate, or None to invalidate all pages.
+        """
+        if page is None:
+            self.rap_cache.clear()
+        else:
+            for key in [key for key in self.rap_cache if key[0] == page]:
+                del self.rap_cache[key]
+
+    def readRegisters(self, node, page, register, length, now=monotonic):
         """Reads one or more registers from a remote node, returning them as a raw string.
 
         Arguments:
@@ -256,7 +407,7 @@ class Bus(object):
                 message.response and not message.write and message.page == page and \
                 message.register == register
         message = self._receiveUntil(is_reply, now=now)
-        return message and message.data
+        return message and message.data.tobytes()
 
     def writeRegisters(self, node, page, register, data):
         """Writes one or more registers on a remote node.
@@ -278,3 +429,266 @@ class Bus(object):
             page=page,
             register=register,
             data=data))
+
+    def _handleBTP(self, message):
+        if not message.control:
+            return self._handleBTPData(message)
+
+        if message.opcode == BTPMessage.BEGIN:
+            self.bulk_transfers.pop(message.sender, None)
+            if message.length > self.bulk_max_length or \
+                    self._bulkBuffered() + message.length > self.bulk_max_total:
+                self._abortTransfer(message.sender)
+                return True
+            transfer = _IncomingTransfer(message.length)
+            self.bulk_transfers[message.sender] = transfer
+            self._ackTransfer(message.sender, transfer)
+            if transfer.frames == 0:
+                self._completeTransfer(message, transfer)
+                return False
+            return True
+        elif message.opcode == BTPMessage.STATUS:
+            transfer = self.bulk_transfers.get(message.sender)
+            if transfer:
+                self._ackTransfer(message.sender, transfer)
+            else:
+                self._abortTransfer(message.sender)
+            return True
+        elif message.opcode == BTPMessage.ABORT:
+            self.bulk_transfers.pop(message.sender, None)
+
+        # ACKs and ABORTs are returned to sendTransfer
+        return False
+    handlers[BTPMessage] = _handleBTP
+
+    def _handleBTPData(self, message):
+        transfer = self.bulk_transfers.get(message.sender)
+        if not transfer or transfer.next_frame == transfer.frames:
+            return True
+
+        offset = (message.sequence - transfer.next_frame) % BTPMessage.SEQUENCE_MODULUS
+        if offset != 0:
+            if offset < BTPMessage.SEQUENCE_MODULUS - BTPMessage.MAX_BLOCK_SIZE and not transfer.nak_sent:
+                # We missed a frame; ask the sender to go back to the one we're expecting
+                transfer.nak_sent = True
+                self._ackTransfer(message.sender, transfer)
+            # Otherwise it's a retransmission of a frame we already have
+            return True
+
+        start = transfer.next_frame * BTPMessage.FRAME_SIZE
+        if len(message.data) != min(BTPMessage.FRAME_SIZE, len(transfer.buffer) - start):
+            return True
+        transfer.view[start:start + len(message.data)] = message.data
+        transfer.next_frame += 1
+        transfer.block_remaining -= 1
+        transfer.nak_sent = False
+
+        if transfer.next_frame == transfer.frames:
+            self._ackTransfer(message.sender, transfer)
+            self._completeTransfer(message, transfer)
+            return False
+        if transfer.block_remaining <= 0:
+            self._ackTransfer(message.sender, transfer)
+        return True
+
+    def _bulkBuffered(self):
+        return sum(len(transfer.buffer) for transfer in self.bulk_transfers.values()
+                   if transfer.buffer is not None) + \
+            sum(len(payload) for sender, payload in self.bulk_completed)
+
+    def _completeTransfer(self, message, transfer):
+        # Hand the buffer over to the completed queue; the transfer state is kept only to repeat the final ACK
+        message.transfer = transfer.view
+        self.bulk_completed.append((message.sender, transfer.view))
+        transfer.buffer = None
+        transfer.view = None
+
+    def _abortTransfer(self, sender):
+        self.send(BTPMessage(
+            sender=self.node_id,
+            recipient=sender,
+            control=True,
+            sequence=0,
+            opcode=BTPMessage.ABORT))
+
+    def _ackTransfer(self, sender, transfer):
+        # Larger blocks would make the 5-bit sequence numbers in ACKs ambiguous
+        transfer.block_remaining = min(self.bulk_block_size, BTPMessage.MAX_BLOCK_SIZE,
+                                       transfer.frames - transfer.next_frame)
+        self.send(BTPMessage(
+            sender=self.node_id,
+            recipient=sender,
+            control=True,
+            sequence=transfer.next_frame % BTPMessage.SEQUENCE_MODULUS,
+            opcode=BTPMessage.ACK,
+            block_size=transfer.block_remaining))
+
+    def sendTransfer(self, node, data, now=monotonic):
+        """Sends a payload of any length to a remote node using BTP.
+
+        Arguments:
+          node: The Node to send the payload to.
+          data: The payload to send, as a string or other buffer.
+
+        Returns:
+          True if the remote node acknowledged the whole payload, False if it aborted the transfer or
+          stopped responding.
+        """
+        view = memoryview(data)
+        frames = (len(view) + BTPMessage.FRAME_SIZE - 1) // BTPMessage.FRAME_SIZE
+
+        def control(opcode, **kwargs):
+            self.send(BTPMessage(
+                sender=self.node_id,
+                recipient=node.node_id,
+                control=True,
+                sequence=0,
+                opcode=opcode,
+                **kwargs))
+
+        def is_reply(message):
+            return isinstance(message, BTPMessage) and message.sender == node.node_id and \
+                message.control and message.opcode in (BTPMessage.ACK, BTPMessage.ABORT)
+
+        started = False
+        base = 0  # First frame not yet acknowledged
+        sent = 0  # Number of frames sent since base
+        retries = 0
+        control(BTPMessage.BEGIN, length=len(view))
+        while True:
+            reply = self._receiveUntil(is_reply, now=now)
+            if not reply:
+                retries += 1
+                if retries > self.bulk_retries:
+                    return False
+                if started:
+                    control(BTPMessage.STATUS)
+                else:
+                    control(BTPMessage.BEGIN, length=len(view))
+                continue
+            if reply.opcode == BTPMessage.ABORT:
+                return False
+
+            offset = (reply.sequence - base) % BTPMessage.SEQUENCE_MODULUS
+            if offset > sent:
+                # Stale acknowledgement for an earlier block
+                continue
+            started = True
+            retries = 0
+            base += offset
+            if reply.block_size == 0:
+                return base == frames
+
+            sent = min(reply.block_size, BTPMessage.MAX_BLOCK_SIZE, frames - base)
+            for i in range(base, base + sent):
+                self.send(BTPMessage(
+                    sender=self.node_id,
+                    recipient=node.node_id,
+                    control=False,
+                    sequence=i % BTPMessage.SEQUENCE_MODULUS,
+                    data=view[i * BTPMessage.FRAME_SIZE:(i + 1) * BTPMessage.FRAME_SIZE]))
+
+    def receiveTransfer(self, node=None, now=monotonic):
+        """Waits for a BTP transfer from a remote node to complete.
+
+        Transfers that completed while something else was receiving from the bus are returned first.
+
+        Arguments:
+          node: The Node to receive from, or None to accept a transfer from any node.
+
+        Returns:
+          A memoryview over the reassembled payload, or None if no transfer completed in time.
+        """
+        def completed():
+            for i, (sender, payload) in enumerate(self.bulk_completed):
+                if node is None or sender == node.node_id:
+                    del self.bulk_completed[i]
+                    return payload
+            return None
+
+        def is_transfer(message):
+            return isinstance(message, BTPMessage) and message.transfer is not None and \
+                (node is None or message.sender == node.node_id)
+
+        payload = completed()
+        if payload is None and self._receiveUntil(is_transfer, now=now):
+            payload = completed()
+        return payload
+
+    def publishRegisters(self, page, register, length, now=monotonic):
+        """Broadcasts the current value of one or more local registers to all nodes.
+
+        Intended to be called periodically, or whenever the registers may have changed. Publications are
+        rate limited to one per publish_min_interval for each register range, and unchanged values are
+        only republished once every publish_max_interval.
+
+        Arguments:
+          page: The page number to publish from.
+          register: The starting register number to publish.
+          length: The number of bytes to publish, maximum 7.
+
+        Returns:
+          True if a publication was sent, False if it was suppressed.
+        """
+        if length > 7:
+            raise ValueError("Publication too long: Only a maximum of 7 bytes may be published at once.")
+
+        read_handler, write_handler = self.register_map.get(page, (None, None))
+        if read_handler:
+            data = ''.join(read_handler(self, page, (register + i) % 256) for i in range(length))
+        else:
+            data = '\0' * length
+
+        key = (page, register, length)
+        timestamp = now()
+        if key in self.published:
+            last_data, last_timestamp = self.published[key]
+            elapsed = timestamp - last_timestamp
+            if elapsed < self.publish_min_interval:
+                return False
+            if data == last_data and elapsed < self.publish_max_interval:
+                return False
+        self.published[key] = (data, timestamp)
+
+        self.send(TelemetryMessage(
+            sender=self.node_id,
+            page=page,
+            register=register,
+            data=data))
+        return True
+
+    def _handleTelemetry(self, message):
+        timestamp = self.now()
+        for i, value in enumerate(message.data):
+            register = (message.register + i) % 256
+            key = (message.sender, message.page, register)
+            previous = self.telemetry.get(key)
+            self.telemetry[key] = (value, timestamp)
+            if previous and previous[0] == value:
+                continue
+            for callback, node, page in self.subscribers:
+                if (node is None or node.node_id == message.sender) and (page is None or page == message.page):
+                    callback(self, message.sender, message.page, register, value)
+        return True
+    handlers[TelemetryMessage] = _handleTelemetry
+
+    def subscribe(self, callback, node=None, page=None):
+        """Registers a callback for changes in published register values.
+
+        Arguments:
+          callback: A function to call when a published register changes value.
+            This function will be called with the arguments (bus, node_id, page, register, data), where data
+            is a single character string.
+          node: The Node to watch, or None to watch all nodes.
+          page: The page number to watch, or None to watch all pages.
+        """
+        self.subscribers.append((callback, node, page))
+
+    def getTelemetry(self, node, page, register):
+        """Returns the last published value of a register on a remote node.
+
+        Returns:
+          A (data, timestamp) tuple, where data is a single character string and timestamp is the
+          Bus.now() time it was received, or None if the register has not been published.
+        """
+        return self.telemetry.get((node.node_id, page, register))
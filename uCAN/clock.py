@@ -0,0 +1,27 @@
+import ctypes
+import ctypes.util
+import os
+import time
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    CLOCK_MONOTONIC = 1
+
+    class _Timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    _librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+    _clock_gettime = _librt.clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+
+    def monotonic():
+        """Returns the value of a clock that never goes backwards, in seconds.
+
+        Only differences between values are meaningful; use it for timeouts and latency measurements.
+        """
+        t = _Timespec()
+        if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return t.tv_sec + t.tv_nsec * 1e-9
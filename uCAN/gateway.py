@@ -0,0 +1,155 @@
+import Queue
+import collections
+import threading
+from can.interfaces import socketcan_ctypes
+from uCAN.clock import monotonic
+from uCAN.messages import UnicastMessage
+
+
+def _isBroadcast(arbitration_id):
+    return (arbitration_id >> 26) & 0x1
+
+
+def _recipient(arbitration_id):
+    return (arbitration_id >> 8) & 0xFF
+
+
+def _sender(arbitration_id):
+    return arbitration_id & 0xFF
+
+
+class Gateway(object):
+    """Bridges uCAN traffic between several CAN buses.
+
+    Each segment gets a reader thread and a writer thread with its own transmit queue, so a slow or busy
+    segment can't hold up the others. Routing decisions are made from the arbitration ID alone, without
+    decoding frames: the gateway learns which segment each node is on from the sender field of its frames,
+    sends unicast frames only to the segment their recipient is on, and floods broadcasts and frames for
+    unknown nodes to every other segment. A node heard on a new segment is re-learned there immediately.
+
+    To stop frames looping, the gateway remembers each frame it transmits on a segment for loop_window
+    seconds; if an identical frame then arrives on that segment, it is taken to be our own frame coming back
+    and is dropped.
+    """
+    def __init__(self, buses, learn_timeout=60.0, loop_window=0.1, queue_size=1024, now=monotonic):
+        """Constructs a gateway.
+
+        Arguments:
+          buses: A list of CAN buses, or names of socketcan interfaces, one for each segment.
+          learn_timeout: How long a learned route stays valid after the node was last heard from.
+          loop_window: How long a transmitted frame is remembered for loop suppression.
+          queue_size: The maximum number of frames waiting to be sent on each segment.
+        """
+        self.segments = [socketcan_ctypes.Bus(bus) if isinstance(bus, basestring) else bus for bus in buses]
+        self.learn_timeout = learn_timeout
+        self.loop_window = loop_window
+        self.now = now
+        self.lock = threading.Lock()
+        # Per segment, counts of recently transmitted frames, and the order they expire in
+        self.transmitted = [{} for segment in self.segments]
+        self.transmitted_expiry = [collections.deque() for segment in self.segments]
+        self.route_segments = [None] * 256
+        self.route_times = [0.0] * 256
+        self.queues = [Queue.Queue(queue_size) for segment in self.segments]
+        self.forwarded = [0] * len(self.segments)
+        self.dropped = [0] * len(self.segments)
+        self.running = False
+        self.threads = []
+
+    def route(self, segment, frame):
+        """Returns a list of the segments a frame received on a given segment should be forwarded to."""
+        if frame.is_error_frame or not frame.id_type:
+            return []
+
+        arbitration_id = frame.arbitration_id
+        now = self.now()
+        transmitted = self.transmitted[segment]
+        self._expireTransmitted(segment, now)
+        key = (arbitration_id, str(frame.data))
+        count = transmitted.get(key)
+        if count:
+            # We sent this frame on this segment ourselves; it has come back round
+            if count == 1:
+                del transmitted[key]
+            else:
+                transmitted[key] = count - 1
+            return []
+
+        sender = _sender(arbitration_id)
+        if sender != UnicastMessage.BROADCAST_RECIPIENT:
+            self.route_segments[sender] = segment
+            self.route_times[sender] = now
+
+        if not _isBroadcast(arbitration_id):
+            recipient = _recipient(arbitration_id)
+            if recipient != UnicastMessage.BROADCAST_RECIPIENT:
+                recipient_segment = self.route_segments[recipient]
+                if recipient_segment is not None and now - self.route_times[recipient] < self.learn_timeout:
+                    return [] if recipient_segment == segment else [recipient_segment]
+
+        return [i for i in range(len(self.segments)) if i != segment]
+
+    def _expireTransmitted(self, segment, now):
+        transmitted = self.transmitted[segment]
+        expiry = self.transmitted_expiry[segment]
+        while expiry and expiry[0][0] <= now:
+            key = expiry.popleft()[1]
+            count = transmitted.get(key)
+            if count == 1:
+                del transmitted[key]
+            elif count:
+                transmitted[key] = count - 1
+
+    def forward(self, segment, frame):
+        """Queues a frame received on a given segment for transmission on the segments it should go to."""
+        with self.lock:
+            targets = self.route(segment, frame)
+            if targets:
+                key = (frame.arbitration_id, str(frame.data))
+                now = self.now()
+                expires = now + self.loop_window
+            for target in targets:
+                # A segment we only ever send to never gets to expire its entries in route()
+                self._expireTransmitted(target, now)
+                try:
+                    self.queues[target].put_nowait(frame)
+                except Queue.Full:
+                    self.dropped[target] += 1
+                    continue
+                self.forwarded[target] += 1
+                self.transmitted[target][key] = self.transmitted[target].get(key, 0) + 1
+                self.transmitted_expiry[target].append((expires, key))
+
+    def _read(self, segment):
+        bus = self.segments[segment]
+        while self.running:
+            frame = bus.recv(0.1)
+            if frame:
+                self.forward(segment, frame)
+
+    def _write(self, segment):
+        bus = self.segments[segment]
+        queue = self.queues[segment]
+        while self.running:
+            try:
+                frame = queue.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            bus.send(frame)
+
+    def start(self):
+        """Starts forwarding frames in background threads."""
+        self.running = True
+        for segment in range(len(self.segments)):
+            for target in (self._read, self._write):
+                thread = threading.Thread(target=target, args=(segment,))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def stop(self):
+        """Stops forwarding frames, waiting for the background threads to exit."""
+        self.running = False
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
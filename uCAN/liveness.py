@@ -0,0 +1,82 @@
+import array
+from uCAN.clock import monotonic
+from uCAN.messages import Priority, UnicastMessage, YARPMessage
+
+
+class NodeMonitor(object):
+    """Tracks which nodes are alive by watching the traffic they send.
+
+    Every frame seen on the bus counts as a sign of life from its sender, so nodes that talk regularly are
+    never pinged. Only nodes that have been silent for longer than silence_timeout are pinged by check(),
+    and are marked down if they don't reply.
+    """
+    def __init__(self, bus, silence_timeout=5.0, on_up=None, on_down=None, now=monotonic):
+        """Constructs a node monitor and attaches it to a bus.
+
+        Arguments:
+          bus: The Bus to watch.
+          silence_timeout: How long a node may be silent before it is pinged.
+          on_up: A function to call when a node comes up, with the arguments (bus, node_id).
+          on_down: A function to call when a node goes down, with the arguments (bus, node_id).
+        """
+        self.bus = bus
+        self.silence_timeout = silence_timeout
+        self.on_up = on_up
+        self.on_down = on_down
+        self.now = now
+        self.last_seen = array.array('d', [0.0] * 256)
+        self.alive = bytearray(256)
+        bus.observers.append(self.observe)
+
+    def observe(self, message):
+        sender = message.sender
+        if sender == UnicastMessage.BROADCAST_RECIPIENT:
+            return
+        self.last_seen[sender] = self.now()
+        if not self.alive[sender]:
+            self.alive[sender] = 1
+            if self.on_up:
+                self.on_up(self.bus, sender)
+
+    def isAlive(self, node):
+        """Returns True if a Node has been seen and has not since gone down."""
+        return bool(self.alive[node.node_id])
+
+    def aliveNodes(self):
+        """Returns a list of the node IDs of all nodes currently believed to be up."""
+        return [node_id for node_id in range(256) if self.alive[node_id]]
+
+    def check(self):
+        """Pings all nodes that have gone silent, and marks the ones that don't reply as down.
+
+        The pings are all sent at once, so this takes at most one bus timeout regardless of how many nodes
+        have gone quiet.
+
+        Returns:
+          A list of the node IDs that were marked down.
+        """
+        start = self.now()
+        threshold = start - self.silence_timeout
+        silent = [node_id for node_id in range(256)
+                  if self.alive[node_id] and self.last_seen[node_id] < threshold and node_id != self.bus.node_id]
+        if not silent:
+            return []
+
+        for node_id in silent:
+            self.bus.send(YARPMessage(
+                sender=self.bus.node_id,
+                recipient=node_id,
+                query=True,
+                response=False,
+                priority=Priority.low))
+
+        def all_replied(message):
+            return all(self.last_seen[node_id] >= start for node_id in silent)
+        self.bus._receiveUntil(all_replied, now=self.now)
+
+        down = [node_id for node_id in silent if self.last_seen[node_id] < start]
+        for node_id in down:
+            self.alive[node_id] = 0
+            if self.on_down:
+                self.on_down(self.bus, node_id)
+        return down
@@ -1,5 +1,6 @@
 import bitstring
 import enum
+import struct
 
 
 class HardwareId(object):
@@ -29,6 +30,11 @@ class HardwareId(object):
         return hash(self.hwid)
 
 
+def _checkLength(body, length):
+    if len(body) < length:
+        raise bitstring.ReadError("Message body too short: needed %d bytes but only %d available" % (length, len(body)))
+
+
 class Priority(enum.IntEnum):
     emergency = 0
     high = 1
@@ -37,10 +43,16 @@ class Priority(enum.IntEnum):
 
 
 class Message(object):
-    def __init__(self, protocol, priority=Priority.normal, sender=None):
+    def __init__(self, protocol, priority=Priority.normal, sender=None, timestamp=None):
         self.priority = priority
         self.protocol = protocol
         self.sender = sender
+        # For received messages, the CAN interface's receive timestamp. With socketcan this is wall clock
+        # (epoch) time, so it can be compared with other interface timestamps but not with monotonic() times.
+        self.timestamp = timestamp
+        # For received messages, the Bus.now() time at which the bus received the frame; use this when
+        # measuring round trip times or handler latency against times taken from the same clock.
+        self.received_at = None
 
     def encodeHeader(self, subfields):
         return bitstring.pack('uint:2, bits:19, uint:8', self.priority, subfields, self.sender)
@@ -48,12 +60,25 @@ class Message(object):
     def encodeBody(self):
         raise NotImplementedError()
 
+    def encodeData(self):
+        """Returns the message body as a string or other buffer, ready to be sent in a CAN frame.
+
+        Subclasses override this to build the body directly, without going through bitstring."""
+        return self.encodeBody().bytes
+
     @classmethod
-    def decode(cls, header, body):
+    def decode(cls, header, body, timestamp=None):
+        """Decodes a message from a 29 bit header and a body.
+
+        The body may be a string, bytearray, memoryview or bitstring. Data fields of the decoded message are
+        memoryviews of the body where possible, so a received frame's buffer is not copied; callers that keep
+        them beyond the life of the frame should copy them with tobytes().
+        """
         if isinstance(header, (int, long)):
             header = bitstring.BitString(uint=header, length=29)
-        if isinstance(body, (str, bytearray)):
-            body = bitstring.BitString(bytes=body)
+        if isinstance(body, bitstring.Bits):
+            body = body.tobytes()
+        body = memoryview(body)
 
         priority = header.read('uint:2')
         broadcast = header.read('bool')
@@ -62,6 +87,7 @@ class Message(object):
         else:
             message = UnicastMessage.decode(priority, header, body)
         message.sender = header.read('uint:8')
+        message.timestamp = timestamp
         return message
 
 
@@ -93,9 +119,53 @@ class UnknownBroadcastMessage(BroadcastMessage):
         return super(UnknownBroadcastMessage, self).encodeHeader(self.subfields)
 
     def encodeBody(self):
+        return bitstring.Bits(bytes=self.body)
+
+    def encodeData(self):
         return self.body
 
 
+class TelemetryMessage(BroadcastMessage):
+    """Broadcast publication of the current value of a range of registers on the sending node."""
+    PROTOCOL_NUMBER = 0
+
+    def __init__(self, page, register, data, **kwargs):
+        super(TelemetryMessage, self).__init__(TelemetryMessage.PROTOCOL_NUMBER, **kwargs)
+        self.page = page
+        self.register = register
+        self.data = data
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    @classmethod
+    def decode(cls, priority, protocol, header, body):
+        page = header.read('uint:8')
+        header.read('pad:3')
+        size = header.read('uint:3')
+
+        _checkLength(body, 1 + size)
+        register = ord(body[0])
+        data = body[1:1 + size]
+
+        return cls(page, register, data, priority=priority)
+
+    def encodeHeader(self):
+        return super(TelemetryMessage, self).encodeHeader(
+            bitstring.pack("uint:8, pad:3, uint:3", self.page, self.size))
+
+    def encodeBody(self):
+        return bitstring.pack("uint:8, bytes", self.register, self.data)
+
+    def encodeData(self):
+        data = bytearray(1 + len(self.data))
+        data[0] = self.register
+        data[1:] = self.data
+        return data
+BroadcastMessage.broadcast_protocols[TelemetryMessage.PROTOCOL_NUMBER] = TelemetryMessage
+
+
 class UnicastMessage(Message):
     BROADCAST_RECIPIENT = 0xFF
 
@@ -132,6 +202,9 @@ class UnknownUnicastMessage(UnicastMessage):
         return super(UnknownUnicastMessage, self).encodeHeader(self.subfields)
 
     def encodeBody(self):
+        return bitstring.Bits(bytes=self.body)
+
+    def encodeData(self):
         return self.body
 
 
@@ -152,13 +225,17 @@ class YARPMessage(UnicastMessage):
         has_hwid = header.read('bool')
         header.read('pad:3')
 
+        offset = 0
         hardware_id = None
         if has_hwid:
-            hardware_id = HardwareId(body.read('bytes:7'))
+            _checkLength(body, 7)
+            hardware_id = HardwareId(body[0:7].tobytes())
+            offset = 7
 
         new_node_id = None
         if not response and not query:
-            new_node_id = body.read('uint:8')
+            _checkLength(body, offset + 1)
+            new_node_id = ord(body[offset])
 
         return cls(query, response, hardware_id, new_node_id, priority=priority)
 
@@ -173,6 +250,14 @@ class YARPMessage(UnicastMessage):
             return bitstring.pack("bytes:7", self.hardware_id.hwid)
         else:
             return bitstring.BitString()
+
+    def encodeData(self):
+        if not self.response and not self.query:
+            return self.hardware_id.hwid + chr(self.new_node_id)
+        elif self.hardware_id is not None:
+            return self.hardware_id.hwid
+        else:
+            return ''
 UnicastMessage.unicast_protocols[YARPMessage.PROTOCOL_NUMBER] = YARPMessage
 
 
@@ -217,9 +302,10 @@ class RAPMessage(UnicastMessage):
         header.read('pad:1')
         size = header.read('uint:3')
 
-        page = body.read('uint:8')
-        register = body.read('uint:8')
-        data = body.read('bytes')
+        _checkLength(body, 2)
+        page = ord(body[0])
+        register = ord(body[1])
+        data = body[2:]
 
         return cls(write, response, page, register, data, size=size, priority=priority)
 
@@ -232,4 +318,94 @@ class RAPMessage(UnicastMessage):
             return bitstring.pack("uint:8, uint:8, bytes", self.page, self.register, self.data)
         else:
             return bitstring.pack("uint:8, uint:8", self.page, self.register)
+
+    def encodeData(self):
+        if self.write or self.response:
+            data = bytearray(2 + len(self.data))
+            data[2:] = self.data
+        else:
+            data = bytearray(2)
+        data[0] = self.page
+        data[1] = self.register
+        return data
 UnicastMessage.unicast_protocols[RAPMessage.PROTOCOL_NUMBER] = RAPMessage
+
+
+class BTPMessage(UnicastMessage):
+    """Bulk Transfer Protocol message, used to move payloads too large for a single RAP write.
+
+    Data frames carry up to 8 bytes of payload each, numbered with a sequence number in the header.
+    Control frames carry an opcode in the first byte of the body:
+      BEGIN: Sent by the sender to start a transfer; carries the total length of the payload.
+      ACK: Sent by the receiver; the sequence number is the next frame it expects, and block_size the
+        number of frames the sender may send before waiting for another ACK. A block size of 0 means
+        the transfer is complete.
+      ABORT: Sent by either side to cancel a transfer.
+      STATUS: Sent by the sender to ask the receiver to repeat its last ACK.
+    """
+    PROTOCOL_NUMBER = 2
+
+    BEGIN = 0
+    ACK = 1
+    ABORT = 2
+    STATUS = 3
+
+    SEQUENCE_MODULUS = 32
+    MAX_BLOCK_SIZE = 16
+    FRAME_SIZE = 8
+
+    def __init__(self, control, sequence, data=None, opcode=None, length=None, block_size=None, **kwargs):
+        super(BTPMessage, self).__init__(BTPMessage.PROTOCOL_NUMBER, **kwargs)
+        self.control = control
+        self.sequence = sequence
+        self.data = data
+        self.opcode = opcode
+        self.length = length
+        self.block_size = block_size
+        # Set by the receiving Bus on the frame that completes a transfer
+        self.transfer = None
+
+    @classmethod
+    def decode(cls, priority, protocol, header, body):
+        control = header.read('bool')
+        sequence = header.read('uint:5')
+
+        if not control:
+            return cls(control, sequence, data=body, priority=priority)
+
+        _checkLength(body, 1)
+        opcode = ord(body[0])
+        length = None
+        block_size = None
+        if opcode == cls.BEGIN:
+            _checkLength(body, 5)
+            length = struct.unpack_from('>I', body, 1)[0]
+        elif opcode == cls.ACK:
+            _checkLength(body, 2)
+            block_size = ord(body[1])
+        return cls(control, sequence, opcode=opcode, length=length, block_size=block_size, priority=priority)
+
+    def encodeHeader(self):
+        return super(BTPMessage, self).encodeHeader(
+            bitstring.pack("bool, uint:5", self.control, self.sequence))
+
+    def encodeBody(self):
+        if not self.control:
+            return bitstring.Bits(bytes=self.data)
+        elif self.opcode == BTPMessage.BEGIN:
+            return bitstring.pack("uint:8, uint:32", self.opcode, self.length)
+        elif self.opcode == BTPMessage.ACK:
+            return bitstring.pack("uint:8, uint:8", self.opcode, self.block_size)
+        else:
+            return bitstring.pack("uint:8", self.opcode)
+
+    def encodeData(self):
+        if not self.control:
+            return self.data
+        elif self.opcode == BTPMessage.BEGIN:
+            return struct.pack('>BI', self.opcode, self.length)
+        elif self.opcode == BTPMessage.ACK:
+            return struct.pack('>BB', self.opcode, self.block_size)
+        else:
+            return struct.pack('>B', self.opcode)
+UnicastMessage.unicast_protocols[BTPMessage.PROTOCOL_NUMBER] = BTPMessage
@@ -0,0 +1,169 @@
+import collections
+from uCAN import state
+from uCAN.clock import monotonic
+from uCAN.bus import Bus
+from uCAN.messages import HardwareId, UnicastMessage, YARPMessage
+
+
+class NameServer(Bus):
+    """A Bus that assigns node IDs to other nodes.
+
+    Nodes starting up broadcast a YARP query for their own hardware ID; the name server answers on behalf of
+    the node with the node ID it should use, allocating a new one if the hardware ID hasn't been seen before.
+    New IDs are taken from 0x80-0xFE by default, so they can't collide with the IDs nodes pick for themselves
+    when there is no name server.
+
+    The name server also watches all traffic for ping replies and address assignments, learning node IDs it
+    did not assign and reassigning nodes it finds using an ID that belongs to another node.
+
+    The node table is written to disk at the end of start() and whenever save() is called, not as it changes;
+    call save() periodically to persist allocations made since then.
+    """
+    handlers = dict(Bus.handlers)
+
+    def __init__(self, bus, hardware_id, path=None, node_ids=range(0x80, 0xFF)):
+        """Constructs a name server.
+
+        Arguments:
+          bus: A CAN bus, or the name of a socketcan interface.
+          hardware_id: The hardware ID of the name server itself.
+          path: A file to persist the node table to, or None to keep it in memory only.
+          node_ids: The node IDs the name server may allocate.
+        """
+        super(NameServer, self).__init__(bus, hardware_id)
+        self.path = path
+        self.node_ids = {}
+        self.hardware_ids = {}
+        # Only IDs from this set are ever handed out, even after learning and releasing others
+        self.allocatable_node_ids = frozenset(node_ids)
+        self.free_node_ids = collections.deque(node_ids)
+        # Whether the node table has changed since it was last saved
+        self.dirty = False
+        self.observers.append(self._observe)
+
+        if path:
+            table = state.load(path).get('nodes', {})
+            for hardware_id, node_id in table.items():
+                self._record(HardwareId(hardware_id), node_id)
+            self.dirty = False
+
+    def start(self, default_node_id=None, now=monotonic):
+        """Takes a node ID for the name server itself, without probing the bus."""
+        node_id = self.node_ids.get(self.hardware_id)
+        if node_id is None:
+            node_id = default_node_id if default_node_id is not None else self._allocate()
+            if node_id is None:
+                raise RuntimeError("No node IDs left for the name server to take for itself.")
+            self._record(self.hardware_id, node_id)
+        self.node_id = node_id
+        self.save()
+
+    def _allocate(self):
+        if not self.free_node_ids:
+            return None
+        return self.free_node_ids.popleft()
+
+    def _free(self, node_id):
+        if node_id in self.allocatable_node_ids:
+            self.free_node_ids.append(node_id)
+
+    def _record(self, hardware_id, node_id):
+        old_node_id = self.node_ids.get(hardware_id)
+        if old_node_id == node_id:
+            return
+        if old_node_id is not None:
+            del self.hardware_ids[old_node_id]
+            self._free(old_node_id)
+        old_hardware_id = self.hardware_ids.get(node_id)
+        if old_hardware_id is not None:
+            del self.node_ids[old_hardware_id]
+        try:
+            self.free_node_ids.remove(node_id)
+        except ValueError:
+            pass
+
+        self.node_ids[hardware_id] = node_id
+        self.hardware_ids[node_id] = hardware_id
+        self.dirty = True
+
+    def save(self):
+        """Writes the node table to the file given at construction time, if it has changed since last saved."""
+        if not self.path or not self.dirty:
+            return
+        state.save(self.path, {'nodes': dict((str(k), v) for k, v in self.node_ids.items())})
+        self.dirty = False
+
+    def assign(self, hardware_id, node_id=None):
+        """Assigns a node ID to a node and tells the node to use it.
+
+        Arguments:
+          hardware_id: The Hardware ID of the node to assign an address to.
+          node_id: The node ID to assign, or None to allocate an unused one.
+
+        Returns:
+          The assigned node ID, or None if there are no unused node IDs left.
+        """
+        hardware_id = HardwareId(hardware_id)
+        if node_id is None:
+            node_id = self._allocate()
+            if node_id is None:
+                return None
+        self._record(hardware_id, node_id)
+        self.setAddress(hardware_id, node_id)
+        return node_id
+
+    def release(self, hardware_id):
+        """Forgets the node ID assigned to a node, making it available for reuse."""
+        node_id = self.node_ids.pop(HardwareId(hardware_id), None)
+        if node_id is not None:
+            del self.hardware_ids[node_id]
+            self._free(node_id)
+            self.dirty = True
+
+    def _handleYARP(self, message):
+        if message.query and not message.response and message.hardware_id and \
+           message.hardware_id != self.hardware_id and message.recipient == UnicastMessage.BROADCAST_RECIPIENT:
+            node_id = self.node_ids.get(message.hardware_id)
+            if node_id is None and message.sender == UnicastMessage.BROADCAST_RECIPIENT:
+                # An unaddressed node is looking for its own node ID
+                node_id = self._allocate()
+                if node_id is not None:
+                    self._record(message.hardware_id, node_id)
+            if node_id is not None:
+                # Reply on behalf of the node, so the requester learns its node ID from the sender field
+                self.send(YARPMessage(
+                    sender=node_id,
+                    recipient=message.sender,
+                    query=True,
+                    response=True,
+                    hardware_id=message.hardware_id,
+                    priority=message.priority))
+                return True
+        return Bus._handleYARP(self, message)
+    handlers[YARPMessage] = _handleYARP
+
+    def _observe(self, message):
+        if not isinstance(message, YARPMessage) or not message.hardware_id:
+            return
+
+        if not message.query and not message.response:
+            # Another node assigned an address
+            self._record(message.hardware_id, message.new_node_id)
+        elif message.query and message.response and message.sender != UnicastMessage.BROADCAST_RECIPIENT:
+            owner = self.hardware_ids.get(message.sender)
+            if owner is None:
+                self._record(message.hardware_id, message.sender)
+            elif owner != message.hardware_id:
+                self.onDuplicate(message.sender, owner, message.hardware_id)
+
+    def onDuplicate(self, node_id, owner, hardware_id):
+        """Called when a node is seen using a node ID assigned to another node.
+
+        The default implementation assigns the offending node a new node ID.
+
+        Arguments:
+          node_id: The node ID in use by both nodes.
+          owner: The hardware ID of the node the node ID is assigned to.
+          hardware_id: The hardware ID of the node also using it.
+        """
+        self.assign(hardware_id)
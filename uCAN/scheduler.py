@@ -0,0 +1,251 @@
+import collections
+from uCAN.clock import monotonic
+from uCAN.messages import RAPMessage
+
+MAX_READ_LENGTH = 6
+
+
+class PollSpec(object):
+    """A set of registers on a remote node to be read periodically, and statistics on how that's going."""
+    def __init__(self, node, page, register, length, period, callback, deadline, added):
+        self.node = node
+        self.page = page
+        self.register = register
+        self.length = length
+        self.period = period
+        self.callback = callback
+        self.deadline = deadline
+        self.added = added
+        self.completed = 0
+        self.missed = 0
+
+    def rate(self, now):
+        """Returns the number of successful polls per second achieved since the spec was added."""
+        elapsed = now - self.added
+        return self.completed / elapsed if elapsed > 0 else 0.0
+
+
+class _Read(object):
+    """A single RAP read request covering one or more poll specs."""
+    def __init__(self, specs):
+        self.specs = specs
+        self.node_id = specs[0].node.node_id
+        self.page = specs[0].page
+        self.register = specs[0].register
+        self.length = max(spec.register + spec.length for spec in specs) - self.register
+        self.period = specs[0].period
+        self.next_due = None
+        self.sent_at = None
+        # Specs whose deadlines haven't yet passed for the outstanding request
+        self.pending = []
+        # Per spec, how many polls due since next_due have already been counted as missed
+        self.charged = dict.fromkeys(specs, 0)
+
+
+class PollScheduler(object):
+    """Periodically reads registers from many remote nodes.
+
+    Poll specs on the same node and page with the same period whose register ranges overlap or are adjacent
+    are merged into as few RAP reads as possible. Reads with the same period are spread evenly over it rather
+    than sent in a burst, and reads to different registers are kept in flight concurrently instead of waiting
+    for each reply in turn. When more reads are due than may be in flight, those that have waited longest are
+    sent first, and polls that can't be sent before their deadline are counted as missed.
+
+    The scheduler takes over receiving from the bus while it runs: messages other than replies to its reads
+    are handled as usual by the bus, but are not returned to anyone.
+    """
+    def __init__(self, bus, max_in_flight=32, now=monotonic):
+        """Constructs a poll scheduler.
+
+        Arguments:
+          bus: The Bus to poll through.
+          max_in_flight: The maximum number of reads awaiting replies at any one time.
+        """
+        self.bus = bus
+        self.max_in_flight = max_in_flight
+        self.now = now
+        self.specs = []
+        self.reads = []
+        self.in_flight = []
+        self.missed = 0
+        self._planned = True
+
+    def addPoll(self, node, page, register, length, period, callback, deadline=None):
+        """Adds a set of registers to poll.
+
+        Arguments:
+          node: The Node to read from.
+          page: The page number to read from.
+          register: The starting register number to read from.
+          length: The number of bytes to read, maximum 6.
+          period: How often to read the registers, in seconds.
+          callback: A function to call with the values read.
+            This function will be called with the arguments (bus, node_id, page, register, data), where data
+            is a string of length bytes.
+          deadline: How long to wait for a reply before counting a poll as missed. Defaults to the period.
+
+        Returns:
+          A PollSpec, which records how many polls have completed and been missed.
+        """
+        if length > MAX_READ_LENGTH:
+            raise ValueError("Read too long: Only a maximum of 6 bytes may be read at once.")
+        spec = PollSpec(node, page, register, length, period, callback,
+                        period if deadline is None else deadline, self.now())
+        self.specs.append(spec)
+        self._planned = False
+        return spec
+
+    def _plan(self):
+        groups = collections.defaultdict(list)
+        for spec in self.specs:
+            groups[(spec.node.node_id, spec.page, spec.period)].append(spec)
+
+        reads = []
+        for specs in groups.values():
+            specs.sort(key=lambda spec: (spec.register, spec.length))
+            current = [specs[0]]
+            end = specs[0].register + specs[0].length
+            for spec in specs[1:]:
+                new_end = max(end, spec.register + spec.length)
+                if spec.register <= end and new_end - current[0].register <= MAX_READ_LENGTH:
+                    current.append(spec)
+                    end = new_end
+                else:
+                    reads.append(_Read(current))
+                    current = [spec]
+                    end = spec.register + spec.length
+            reads.append(_Read(current))
+
+        # Spread reads with the same period evenly over that period
+        reads.sort(key=lambda read: (read.node_id, read.page, read.register))
+        start = self.now()
+        by_period = collections.defaultdict(list)
+        for read in reads:
+            by_period[read.period].append(read)
+        for period, period_reads in by_period.items():
+            for i, read in enumerate(period_reads):
+                read.next_due = start + period * i / len(period_reads)
+
+        self.reads = reads
+        self.in_flight = []
+        self._planned = True
+
+    def _send(self, read, now, specs):
+        self.bus.send(RAPMessage(
+            sender=self.bus.node_id,
+            recipient=read.node_id,
+            write=False,
+            response=False,
+            page=read.page,
+            register=read.register,
+            size=read.length))
+        read.sent_at = now
+        read.pending = specs
+        self.in_flight.append(read)
+
+    def _chargeUnsent(self, read, now):
+        for spec in read.specs:
+            while read.next_due + read.charged[spec] * read.period + spec.deadline <= now:
+                self._miss([spec])
+                read.charged[spec] += 1
+
+    def _sendDue(self, read, now):
+        # Only the most recent poll due is worth sending; any before it have been superseded
+        latest = 0
+        while read.next_due + (latest + 1) * read.period <= now:
+            latest += 1
+        specs = []
+        for spec in read.specs:
+            if read.charged[spec] < latest:
+                self._miss([spec] * (latest - read.charged[spec]))
+            elif read.charged[spec] == latest:
+                specs.append(spec)
+            read.charged[spec] = 0
+        read.next_due += (latest + 1) * read.period
+        if specs:
+            self._send(read, now, specs)
+
+    def _miss(self, specs):
+        for spec in specs:
+            spec.missed += 1
+            self.missed += 1
+
+    def _receive(self, message):
+        if not isinstance(message, RAPMessage) or not message.response or message.write:
+            return
+        # Several reads may start at the same register; the length of the reply tells them apart
+        for read in self.in_flight:
+            if (read.node_id == message.sender and read.page == message.page
+                    and read.register == message.register and read.length == len(message.data)):
+                break
+        else:
+            return
+        self.in_flight.remove(read)
+        read.sent_at = None
+        for spec in read.pending:
+            offset = spec.register - read.register
+            spec.completed += 1
+            spec.callback(self.bus, read.node_id, spec.page, spec.register,
+                          message.data[offset:offset + spec.length].tobytes())
+        read.pending = []
+
+    def _expire(self, now):
+        for read in list(self.in_flight):
+            self._miss([spec for spec in read.pending if now - read.sent_at >= spec.deadline])
+            read.pending = [spec for spec in read.pending if now - read.sent_at < spec.deadline]
+            if not read.pending:
+                self.in_flight.remove(read)
+                read.sent_at = None
+
+    def step(self, timeout=None):
+        """Sends any reads that are due, and processes replies until the next one is due.
+
+        Arguments:
+          timeout: The longest time to wait for a reply, or None to wait until the next read is due.
+        """
+        if not self._planned:
+            self._plan()
+        if not self.reads:
+            if timeout is not None:
+                self.bus._tryReceive(timeout)
+            return
+
+        now = self.now()
+        self._expire(now)
+
+        # Send the longest-waiting reads first, so one unresponsive node can't starve the rest of in-flight slots
+        due = [read for read in self.reads if read.sent_at is None and read.next_due <= now]
+        due.sort(key=lambda read: read.next_due)
+        for read in due:
+            self._chargeUnsent(read, now)
+            if len(self.in_flight) >= self.max_in_flight:
+                continue
+            self._sendDue(read, now)
+        waiting = [read for read in due if read.sent_at is None and read.next_due <= now]
+
+        events = [read.sent_at + min(spec.deadline for spec in read.pending) for read in self.in_flight]
+        # Reads that can't be sent until another completes are only worth waking up for to count them missed
+        events.extend(read.next_due + read.charged[spec] * read.period + spec.deadline
+                      for read in waiting for spec in read.specs)
+        if len(self.in_flight) < self.max_in_flight:
+            events.extend(read.next_due for read in self.reads if read.sent_at is None)
+        wait = max(0, min(events) - now)
+        if timeout is not None:
+            wait = min(wait, timeout)
+        message = self.bus._tryReceive(wait)
+        if message:
+            self._receive(message)
+
+    def stats(self):
+        """Returns a list of (spec, rate, missed) tuples giving the achieved poll rate and number of missed
+        deadlines for each poll spec."""
+        now = self.now()
+        return [(spec, spec.rate(now), spec.missed) for spec in self.specs]
+
+    def run(self, duration):
+        """Polls for the given number of seconds."""
+        end = self.now() + duration
+        now = self.now()
+        while now < end:
+            self.step(end - now)
+            now = self.now()
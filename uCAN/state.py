@@ -0,0 +1,22 @@
+import json
+import os
+
+
+def load(path):
+    """Loads a state dictionary previously written with save, returning an empty dict if there is none."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+    except ValueError:
+        # A corrupt state file is no worse than a missing one
+        return {}
+
+
+def save(path, state):
+    """Atomically writes a JSON-serializable state dictionary to path."""
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(state, f)
+    os.rename(temp_path, path)
@@ -1,6 +1,9 @@
 import can
+import os
+import shutil
+import tempfile
 import unittest
-from uCAN import bus, messages
+from uCAN import bus, messages, state
 
 
 sample_hwid = "\x01\x23\x45\x67\x89\xAB\xCD"
@@ -80,6 +83,20 @@ class YARPTest(unittest.TestCase):
         # Third message is dropped
         self.assertEquals(ubus._tryReceive(), None)
 
+    def testReceiveTimestamp(self):
+        tb = TestBus()
+        tb.addReceivedMessages([
+            messages.YARPMessage(query=True, response=True, sender=0x20, recipient=0x10, hardware_id=sample_hwid),
+        ])
+        tb.receive_queue[0].timestamp = 1234.5
+        ubus = bus.Bus(tb, sample_hwid)
+        ubus.node_id = 0x10
+        ubus.now = lambda: 7.25
+
+        message = ubus._tryReceive()
+        self.assertEquals(message.timestamp, 1234.5)
+        self.assertEquals(message.received_at, 7.25)
+
     def testReceiveUntil(self):
         times = [0.25, 0.0]
 
@@ -245,6 +262,89 @@ class YARPTest(unittest.TestCase):
         self.assertEquals(ubus.node_id, 0xAA)
 
 
+class WarmStartTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'state.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def testWarmStart(self):
+        state.save(self.path, {'node_id': 0x33, 'nodes': {'01:23:45:67:89:ab:ce': 0x20}})
+        tb = TestBus()
+        ubus = bus.Bus(tb, sample_hwid, state_path=self.path)
+
+        ubus.start(now=fakeTime([0.0, 0.2]))
+        self.assertEquals(ubus.node_id, 0x33)
+
+        # A single ping to check nobody else has taken our address
+        self.assertEquals(len(tb.send_queue), 1)
+        message = tb.getSentMessage()
+        self.assertTrue(message.query)
+        self.assertFalse(message.response)
+        self.assertEquals(message.sender, 0xFF)
+        self.assertEquals(message.recipient, 0x33)
+
+        # Known nodes are confirmed with a ping to the remembered ID rather than a broadcast query
+        tb.addReceivedMessages([
+            messages.YARPMessage(query=True, response=True, sender=0x20, recipient=0x33, hardware_id=sample_hwid_2),
+        ])
+        self.assertEquals(ubus.getNodeFromHardwareId(sample_hwid_2).node_id, 0x20)
+        self.assertEquals(len(tb.send_queue), 1)
+        message = tb.getSentMessage()
+        self.assertTrue(message.query)
+        self.assertFalse(message.response)
+        self.assertEquals(message.recipient, 0x20)
+        self.assertEquals(message.hardware_id, None)
+
+    def testStaleKnownNode(self):
+        state.save(self.path, {'node_id': 0x33, 'nodes': {'01:23:45:67:89:ab:ce': 0x20}})
+        tb = TestBus()
+        tb.addReceivedMessages([
+            # Something else now answers on the remembered ID
+            messages.YARPMessage(query=True, response=True, sender=0x20, recipient=0x33, hardware_id=sample_hwid),
+            # The node itself answers the broadcast query from its new ID
+            messages.YARPMessage(query=True, response=True, sender=0x21, recipient=0x33, hardware_id=sample_hwid_2),
+        ])
+        ubus = bus.Bus(tb, sample_hwid, state_path=self.path)
+        ubus.node_id = 0x33
+
+        self.assertEquals(ubus.getNodeFromHardwareId(sample_hwid_2).node_id, 0x21)
+        self.assertEquals(len(tb.send_queue), 2)
+        self.assertEquals(tb.getSentMessage().recipient, 0x20)
+        message = tb.getSentMessage()
+        self.assertEquals(message.recipient, 0xFF)
+        self.assertEquals(message.hardware_id, sample_hwid_2)
+        self.assertEquals(ubus.known_nodes[messages.HardwareId(sample_hwid_2)], 0x21)
+
+        # Learned nodes are only written out when asked
+        self.assertEquals(state.load(self.path)['nodes'], {'01:23:45:67:89:ab:ce': 0x20})
+        ubus.saveState()
+        self.assertEquals(state.load(self.path)['nodes'], {'01:23:45:67:89:ab:ce': 0x21})
+
+    def testWarmStartConflict(self):
+        state.save(self.path, {'node_id': 0x33})
+        tb = TestBus()
+        tb.addReceivedMessages([
+            # Someone else has our old address
+            messages.YARPMessage(query=True, response=True, sender=0x33,
+                                 recipient=0xFF, hardware_id=sample_hwid_2),
+            # Centrally assigned address
+            messages.YARPMessage(query=True, response=True, sender=0xAA,
+                                 recipient=0xFF, hardware_id=sample_hwid)
+        ])
+        ubus = bus.Bus(tb, sample_hwid, state_path=self.path)
+
+        ubus.start()
+        self.assertEquals(ubus.node_id, 0xAA)
+        self.assertEquals(len(tb.send_queue), 2)
+
+        saved = state.load(self.path)
+        self.assertEquals(saved['node_id'], 0xAA)
+        self.assertEquals(saved['nodes'], {'01:23:45:67:89:ab:ce': 0x33})
+
+
 class RAPTest(unittest.TestCase):
     def testSendWrite(self):
         tb = TestBus()
@@ -324,6 +424,101 @@ class RAPTest(unittest.TestCase):
         self.assertEquals(message.size, 4)
         self.assertEquals(message.data, 'foo\0')
 
+    def testReadCache(self):
+        tb = TestBus()
+        request = messages.RAPMessage(sender=0x20, recipient=0x10, write=False, response=False, page=0, register=0,
+                                      size=2)
+        tb.addReceivedMessages([
+            request,
+            request,
+            messages.RAPMessage(sender=0x21, recipient=0x10, write=True, response=False, page=0, register=0,
+                                data="x"),
+            request,
+        ])
+        ubus = bus.Bus(tb, sample_hwid)
+        ubus.node_id = 0x10
+        ubus.rap_cache_ttl = 60.0
+
+        registers = ['a', 'b']
+        reads = []
+
+        def readReg(bus, page, addr):
+            reads.append(addr)
+            return registers[addr]
+
+        def writeReg(bus, page, addr, data):
+            registers[addr] = data
+        ubus.configureRegisters(0, readReg, writeReg)
+
+        for i in range(4):
+            ubus.receive()
+
+        # Second read is served from the cache, the write invalidates it
+        self.assertEquals(reads, [0, 1, 0, 1])
+        self.assertEquals(len(tb.send_queue), 3)
+        self.assertEquals(tb.getSentMessage().data, 'ab')
+        self.assertEquals(tb.getSentMessage().data, 'ab')
+        self.assertEquals(tb.getSentMessage().data, 'xb')
+
+    def testReadCacheExpiry(self):
+        times = [0.0]
+        tb = TestBus()
+        request = messages.RAPMessage(sender=0x20, recipient=0x10, write=False, response=False, page=0, register=0,
+                                      size=1)
+        tb.addReceivedMessages([request, request, request])
+        ubus = bus.Bus(tb, sample_hwid)
+        ubus.node_id = 0x10
+        ubus.now = lambda: times[0]
+        ubus.rap_cache_ttl = 1.0
+
+        reads = []
+
+        def readReg(bus, page, addr):
+            reads.append(addr)
+            return 'a'
+        ubus.configureRegisters(0, readReg, None)
+
+        ubus.receive()
+        times[0] = 0.5
+        ubus.receive()
+        self.assertEquals(reads, [0])
+
+        # Once the entry is older than the TTL, the handler is called again
+        times[0] = 1.5
+        ubus.receive()
+        self.assertEquals(reads, [0, 0])
+        self.assertEquals(len(tb.send_queue), 3)
+
+    def testRateLimit(self):
+        tb = TestBus()
+        for sender in [0x20, 0x20, 0x20, 0x21]:
+            tb.addReceivedMessages([
+                messages.RAPMessage(sender=sender, recipient=0x10, write=False, response=False, page=0,
+                                    register=0, size=1),
+            ])
+        tb.addReceivedMessages([
+            messages.RAPMessage(sender=0x20, recipient=0x10, write=False, response=False, page=0, register=0,
+                                size=1),
+        ])
+        times = [0.0]
+        ubus = bus.Bus(tb, sample_hwid)
+        ubus.node_id = 0x10
+        ubus.now = lambda: times[0]
+        ubus.rap_rate = 1.0
+        ubus.rap_burst = 2
+
+        for i in range(4):
+            ubus.receive()
+
+        # The third request from 0x20 is dropped, but 0x21 has its own budget
+        self.assertEquals(len(tb.send_queue), 3)
+        self.assertEquals([tb.getSentMessage().recipient for i in range(3)], [0x20, 0x20, 0x21])
+
+        # A second later, 0x20 has earned another token
+        times[0] = 1.0
+        ubus.receive()
+        self.assertEquals(len(tb.send_queue), 1)
+
     def testSendOverlengthRead(self):
         tb = TestBus()
         ubus = bus.Bus(tb, sample_hwid)
@@ -339,5 +534,235 @@ class RAPTest(unittest.TestCase):
         self.assertRaises(ValueError, ubus.writeRegisters, ubus.getNodeFromNodeId(0x20), 0, 0, "foobarbaz")
 
 
+class BTPTest(unittest.TestCase):
+    def testSendTransfer(self):
+        tb = TestBus()
+        tb.addReceivedMessages([
+            messages.BTPMessage(sender=0x20, recipient=0x10, control=True, sequence=0,
+                                opcode=messages.BTPMessage.ACK, block_size=2),
+            messages.BTPMessage(sender=0x20, recipient=0x10, control=True, sequence=2,
+                                opcode=messages.BTPMessage.ACK, block_size=1),
+            messages.BTPMessage(sender=0x20, recipient=0x10, control=True, sequence=3,
+                                opcode=messages.BTPMessage.ACK, block_size=0),
+        ])
+        ubus = bus.Bus(tb, sample_hwid)
+        ubus.node_id = 0x10
+
+        payload = "0123456789abcdefghij"
+        self.assertTrue(ubus.sendTransfer(ubus.getNodeFromNodeId(0x20), payload))
+        self.assertEquals(len(tb.send_queue), 4)
+
+        message = tb.getSentMessage()
+        self.assertTrue(isinstance(message, messages.BTPMessage))
+        self.assertTrue(message.control)
+        self.assertEquals(message.opcode, messages.BTPMessage.BEGIN)
+        self.assertEquals(message.length, 20)
+        self.assertEquals(message.sender, 0x10)
+        self.assertEquals(message.recipient, 0x20)
+
+        for i, chunk in enumerate([payload[0:8], payload[8:16], payload[16:20]]):
+            message = tb.getSentMessage()
+            self.assertFalse(message.control)
+            self.assertEquals(message.sequence, i)
+            self.assertEquals(message.data, chunk)
+
+    def testSendTransferAborted(self):
+        tb = TestBus()
+        tb.addReceivedMessages([
+            messages.BTPMessage(sender=0x20, recipient=0x10, control=True, sequence=0,
+                                opcode=messages.BTPMessage.ABORT),
+        ])
+        ubus = bus.Bus(tb, sample_hwid)
+        ubus.node_id = 0x10
+
+        self.assertFalse(ubus.sendTransfer(ubus.getNodeFromNodeId(0x20), "0123456789"))
+
+    def testReceiveTransfer(self):
+        payload = "0123456789abcdefghij"
+        tb = TestBus()
+        tb.addReceivedMessages([
+            messages.BTPMessage(sender=0x20, recipient=0x10, control=True, sequence=0,
+                                opcode=messages.BTPMessage.BEGIN, length=len(payload)),
+            messages.BTPMessage(sender=0x20, recipient=0x10, control=False, sequence=0, data=payload[0:8]),
+            messages.BTPMessage(sender=0x20, recipient=0x10, control=False, sequence=1, data=payload[8:16]),
+            messages.BTPMessage(sender=0x20, recipient=0x10, control=False, sequence=2, data=payload[16:20]),
+        ])
+        ubus = bus.Bus(tb, sample_hwid)
+        ubus.node_id = 0x10
+        ubus.bulk_block_size = 2
+
+        data = ubus.receiveTransfer(ubus.getNodeFromNodeId(0x20))
+        self.assertTrue(isinstance(data, memoryview))
+        self.assertEquals(data.tobytes(), payload)
+
+        self.assertEquals(len(tb.send_queue), 3)
+        for sequence, block_size in [(0, 2), (2, 1), (3, 0)]:
+            message = tb.getSentMessage()
+            self.assertTrue(isinstance(message, messages.BTPMessage))
+            self.assertTrue(message.control)
+            self.assertEquals(message.opcode, messages.BTPMessage.ACK)
+            self.assertEquals(message.sequence, sequence)
+            self.assertEquals(message.block_size, block_size)
+            self.assertEquals(message.recipient, 0x20)
+
+    def testReceiveTransferTooLong(self):
+        tb = TestBus()
+        tb.addReceivedMessages([
+            messages.BTPMessage(sender=0x20, recipient=0x10, control=True, sequence=0,
+                                opcode=messages.BTPMessage.BEGIN, length=0xFFFFFFF0),
+        ])
+        ubus = bus.Bus(tb, sample_hwid)
+        ubus.node_id = 0x10
+
+        ubus.receive()
+        self.assertEquals(ubus.bulk_transfers, {})
+        self.assertEquals(len(tb.send_queue), 1)
+        message = tb.getSentMessage()
+        self.assertTrue(isinstance(message, messages.BTPMessage))
+        self.assertTrue(message.control)
+        self.assertEquals(message.opcode, messages.BTPMessage.ABORT)
+        self.assertEquals(message.recipient, 0x20)
+
+    def testReceiveTransferWhileBusy(self):
+        tb = TestBus()
+        tb.addReceivedMessages([
+            messages.BTPMessage(sender=0x20, recipient=0x10, control=True, sequence=0,
+                                opcode=messages.BTPMessage.BEGIN, length=8),
+            messages.BTPMessage(sender=0x20, recipient=0x10, control=False, sequence=0, data="01234567"),
+        ])
+        ubus = bus.Bus(tb, sample_hwid)
+        ubus.node_id = 0x10
+
+        # The transfer completes while something else is receiving, and is kept for receiveTransfer
+        ubus.receive()
+        ubus.receive()
+        self.assertEquals(ubus.bulk_transfers[0x20].buffer, None)
+        self.assertEquals(ubus.receiveTransfer(ubus.getNodeFromNodeId(0x20)).tobytes(), "01234567")
+        self.assertEquals(ubus.bulk_completed, [])
+
+    def testReceiveTransferTotalLimit(self):
+        tb = TestBus()
+        tb.addReceivedMessages([
+            messages.BTPMessage(sender=0x20, recipient=0x10, control=True, sequence=0,
+                                opcode=messages.BTPMessage.BEGIN, length=10),
+            messages.BTPMessage(sender=0x21, recipient=0x10, control=True, sequence=0,
+                                opcode=messages.BTPMessage.BEGIN, length=10),
+        ])
+        ubus = bus.Bus(tb, sample_hwid)
+        ubus.node_id = 0x10
+        ubus.bulk_max_total = 16
+
+        ubus.receive()
+        ubus.receive()
+        self.assertEquals(ubus.bulk_transfers.keys(), [0x20])
+        self.assertEquals(tb.getSentMessage().opcode, messages.BTPMessage.ACK)
+        message = tb.getSentMessage()
+        self.assertEquals(message.opcode, messages.BTPMessage.ABORT)
+        self.assertEquals(message.recipient, 0x21)
+
+    def testBlockSizeLimit(self):
+        tb = TestBus()
+        tb.addReceivedMessages([
+            messages.BTPMessage(sender=0x20, recipient=0x10, control=True, sequence=0,
+                                opcode=messages.BTPMessage.BEGIN, length=1024),
+        ])
+        ubus = bus.Bus(tb, sample_hwid)
+        ubus.node_id = 0x10
+        ubus.bulk_block_size = 64
+
+        # We never grant more frames than the sequence numbers can tell apart...
+        ubus.receive()
+        self.assertEquals(tb.getSentMessage().block_size, messages.BTPMessage.MAX_BLOCK_SIZE)
+
+        # ...or send more than that when a peer grants them
+        tb.addReceivedMessages([
+            messages.BTPMessage(sender=0x20, recipient=0x10, control=True, sequence=0,
+                                opcode=messages.BTPMessage.ACK, block_size=64),
+            messages.BTPMessage(sender=0x20, recipient=0x10, control=True, sequence=0,
+                                opcode=messages.BTPMessage.ABORT),
+        ])
+        self.assertFalse(ubus.sendTransfer(ubus.getNodeFromNodeId(0x20), "x" * 1024))
+        self.assertEquals(len(tb.send_queue), 1 + messages.BTPMessage.MAX_BLOCK_SIZE)
+
+    def testReceiveTransferMissedFrame(self):
+        tb = TestBus()
+        tb.addReceivedMessages([
+            messages.BTPMessage(sender=0x20, recipient=0x10, control=True, sequence=0,
+                                opcode=messages.BTPMessage.BEGIN, length=24),
+            messages.BTPMessage(sender=0x20, recipient=0x10, control=False, sequence=0, data="01234567"),
+            messages.BTPMessage(sender=0x20, recipient=0x10, control=False, sequence=2, data="ghijklmn"),
+        ])
+        ubus = bus.Bus(tb, sample_hwid)
+        ubus.node_id = 0x10
+
+        for i in range(3):
+            ubus.receive()
+
+        self.assertEquals(len(tb.send_queue), 2)
+        tb.getSentMessage()
+        message = tb.getSentMessage()
+        self.assertEquals(message.opcode, messages.BTPMessage.ACK)
+        self.assertEquals(message.sequence, 1)
+        self.assertEquals(message.block_size, 2)
+
+
+class TelemetryTest(unittest.TestCase):
+    def testPublish(self):
+        tb = TestBus()
+        ubus = bus.Bus(tb, sample_hwid)
+        ubus.node_id = 0x10
+
+        registers = ['a', 'b', 'c']
+
+        def readReg(bus, page, addr):
+            return registers[addr]
+        ubus.configureRegisters(3, readReg, None)
+
+        self.assertTrue(ubus.publishRegisters(3, 0, 3, now=lambda: 0.0))
+        # Rate limited
+        registers[0] = 'x'
+        self.assertFalse(ubus.publishRegisters(3, 0, 3, now=lambda: 0.005))
+        # Changed
+        self.assertTrue(ubus.publishRegisters(3, 0, 3, now=lambda: 0.1))
+        # Unchanged
+        self.assertFalse(ubus.publishRegisters(3, 0, 3, now=lambda: 0.5))
+        # Unchanged, but due for a refresh
+        self.assertTrue(ubus.publishRegisters(3, 0, 3, now=lambda: 1.1))
+
+        self.assertEquals(len(tb.send_queue), 3)
+        message = tb.getSentMessage()
+        self.assertTrue(isinstance(message, messages.TelemetryMessage))
+        self.assertEquals(message.sender, 0x10)
+        self.assertEquals(message.page, 3)
+        self.assertEquals(message.register, 0)
+        self.assertEquals(message.data, 'abc')
+        self.assertEquals(tb.getSentMessage().data, 'xbc')
+
+        self.assertRaises(ValueError, ubus.publishRegisters, 3, 0, 8)
+
+    def testSubscribe(self):
+        tb = TestBus()
+        tb.addReceivedMessages([
+            messages.TelemetryMessage(sender=0x20, page=3, register=255, data='ab'),
+            messages.TelemetryMessage(sender=0x20, page=3, register=255, data='ac'),
+            messages.TelemetryMessage(sender=0x21, page=3, register=0, data='z'),
+        ])
+        ubus = bus.Bus(tb, sample_hwid)
+        ubus.node_id = 0x10
+
+        changes = []
+        ubus.subscribe(lambda bus, node_id, page, register, data: changes.append((node_id, page, register, data)),
+                       node=ubus.getNodeFromNodeId(0x20))
+
+        ubus.receive()
+        ubus.receive()
+        ubus.receive()
+
+        self.assertEquals(changes, [(0x20, 3, 255, 'a'), (0x20, 3, 0, 'b'), (0x20, 3, 0, 'c')])
+        self.assertEquals(ubus.getTelemetry(ubus.getNodeFromNodeId(0x20), 3, 0)[0], 'c')
+        self.assertEquals(ubus.getTelemetry(ubus.getNodeFromNodeId(0x21), 3, 0)[0], 'z')
+        self.assertEquals(ubus.getTelemetry(ubus.getNodeFromNodeId(0x21), 3, 1), None)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,13 @@
+import unittest
+from uCAN import clock
+
+
+class ClockTest(unittest.TestCase):
+    def testMonotonic(self):
+        times = [clock.monotonic() for i in range(1000)]
+        self.assertEquals(times, sorted(times))
+        self.assertTrue(times[-1] - times[0] < 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,255 @@
+"""Differential tests for the message codecs.
+
+Every decoder and encoder variant registered in DECODERS and ENCODERS is checked against the reference
+bitstring implementation on the same randomly generated corpus, so an optimized codec can be added as a
+variant here and must agree exactly before it replaces anything. Run this module with the argument "bench"
+to time each variant on the corpus instead.
+"""
+import bitstring
+import random
+import sys
+import unittest
+from uCAN import gateway, messages
+from uCAN.clock import monotonic
+
+SEED = 0x0CA7
+CORPUS_SIZE = 2000
+
+
+def referenceDecode(arbitration_id, data):
+    """Decodes a frame using only bitstring reads, as the original implementation did."""
+    header = bitstring.BitString(uint=arbitration_id, length=29)
+    body = bitstring.BitString(bytes=str(data))
+
+    priority = header.read('uint:2')
+    broadcast = header.read('bool')
+    protocol = header.read('uint:4')
+    if broadcast:
+        if protocol == messages.TelemetryMessage.PROTOCOL_NUMBER:
+            page = header.read('uint:8')
+            header.read('pad:3')
+            size = header.read('uint:3')
+            register = body.read('uint:8')
+            message = messages.TelemetryMessage(page, register, body.read('bytes:%d' % (size,)), priority=priority)
+        else:
+            message = messages.UnknownBroadcastMessage(protocol, header.read('bits:14'), body, priority=priority)
+    else:
+        if protocol == messages.YARPMessage.PROTOCOL_NUMBER:
+            query = header.read('bool')
+            response = header.read('bool')
+            has_hwid = header.read('bool')
+            header.read('pad:3')
+            hardware_id = None
+            if has_hwid:
+                hardware_id = messages.HardwareId(body.read('bytes:7'))
+            new_node_id = None
+            if not response and not query:
+                new_node_id = body.read('uint:8')
+            message = messages.YARPMessage(query, response, hardware_id, new_node_id, priority=priority)
+        elif protocol == messages.RAPMessage.PROTOCOL_NUMBER:
+            write = header.read('bool')
+            response = header.read('bool')
+            header.read('pad:1')
+            size = header.read('uint:3')
+            page = body.read('uint:8')
+            register = body.read('uint:8')
+            message = messages.RAPMessage(write, response, page, register, body.read('bytes'), size=size,
+                                          priority=priority)
+        elif protocol == messages.BTPMessage.PROTOCOL_NUMBER:
+            control = header.read('bool')
+            sequence = header.read('uint:5')
+            if not control:
+                message = messages.BTPMessage(control, sequence, data=body.read('bytes'), priority=priority)
+            else:
+                opcode = body.read('uint:8')
+                length = None
+                block_size = None
+                if opcode == messages.BTPMessage.BEGIN:
+                    length = body.read('uint:32')
+                elif opcode == messages.BTPMessage.ACK:
+                    block_size = body.read('uint:8')
+                message = messages.BTPMessage(control, sequence, opcode=opcode, length=length,
+                                              block_size=block_size, priority=priority)
+        else:
+            message = messages.UnknownUnicastMessage(protocol, header.read('bits:6'), body, priority=priority)
+        message.recipient = header.read('uint:8')
+    message.sender = header.read('uint:8')
+    return message
+
+
+DECODERS = {
+    'reference': referenceDecode,
+    'str': lambda arbitration_id, data: messages.Message.decode(arbitration_id, str(data)),
+    'bytearray': lambda arbitration_id, data: messages.Message.decode(arbitration_id, bytearray(data)),
+    'memoryview': lambda arbitration_id, data: messages.Message.decode(arbitration_id, memoryview(data)),
+    'bitstring': lambda arbitration_id, data: messages.Message.decode(
+        bitstring.BitString(uint=arbitration_id, length=29), bitstring.BitString(bytes=str(data))),
+}
+
+ENCODERS = {
+    'reference': lambda message: (message.encodeHeader().uint, message.encodeBody().bytes),
+    'encodeData': lambda message: (message.encodeHeader().uint, str(bytearray(message.encodeData()))),
+}
+
+# Decoding errors every variant may raise on malformed frames; bitstring's errors subclass these
+DECODE_ERRORS = (IndexError, ValueError)
+
+
+def fields(message):
+    """Returns a dictionary of a message's fields, with buffers converted to strings for comparison."""
+    ret = {'type': type(message).__name__}
+    for key, value in vars(message).items():
+        if isinstance(value, memoryview):
+            value = value.tobytes()
+        elif isinstance(value, bytearray):
+            value = str(value)
+        elif isinstance(value, messages.HardwareId):
+            value = value.hwid
+        elif isinstance(value, bitstring.Bits):
+            value = value.tobytes() if key == 'body' else value.bin
+        ret[key] = value
+    return ret
+
+
+def randomBytes(rng, length):
+    return ''.join(chr(rng.randrange(256)) for i in range(length))
+
+
+def randomMessage(rng):
+    """Returns a random valid message of a random type."""
+    kwargs = {'priority': rng.randrange(4), 'sender': rng.randrange(256)}
+    kind = rng.randrange(7)
+    if kind == 0:
+        query, response = rng.choice([(True, False), (True, True), (False, False)])
+        hardware_id = randomBytes(rng, 7) if rng.randrange(2) or not (query or response) else None
+        new_node_id = None if query or response else rng.randrange(256)
+        return messages.YARPMessage(query, response, hardware_id, new_node_id, recipient=rng.randrange(256),
+                                    **kwargs)
+    elif kind == 1:
+        write, response = rng.choice([(True, False), (False, True), (False, False)])
+        page, register = rng.randrange(256), rng.randrange(256)
+        if write or response:
+            return messages.RAPMessage(write, response, page, register, data=randomBytes(rng, rng.randint(1, 6)),
+                                       recipient=rng.randrange(256), **kwargs)
+        return messages.RAPMessage(write, response, page, register, size=rng.randint(1, 7),
+                                   recipient=rng.randrange(256), **kwargs)
+    elif kind == 2:
+        return messages.TelemetryMessage(rng.randrange(256), rng.randrange(256), randomBytes(rng, rng.randint(0, 7)),
+                                         **kwargs)
+    elif kind == 3:
+        return messages.BTPMessage(False, rng.randrange(32), data=randomBytes(rng, rng.randint(0, 8)),
+                                   recipient=rng.randrange(256), **kwargs)
+    elif kind == 4:
+        opcode = rng.choice([messages.BTPMessage.BEGIN, messages.BTPMessage.ACK, messages.BTPMessage.ABORT,
+                             messages.BTPMessage.STATUS])
+        return messages.BTPMessage(True, rng.randrange(32), opcode=opcode,
+                                   length=rng.randrange(2 ** 32) if opcode == messages.BTPMessage.BEGIN else None,
+                                   block_size=rng.randrange(256) if opcode == messages.BTPMessage.ACK else None,
+                                   recipient=rng.randrange(256), **kwargs)
+    elif kind == 5:
+        return messages.UnknownUnicastMessage(rng.randint(3, 15), bitstring.Bits(uint=rng.randrange(64), length=6),
+                                              randomBytes(rng, rng.randint(0, 8)), recipient=rng.randrange(256),
+                                              **kwargs)
+    else:
+        return messages.UnknownBroadcastMessage(rng.randint(1, 15),
+                                                bitstring.Bits(uint=rng.randrange(2 ** 14), length=14),
+                                                randomBytes(rng, rng.randint(0, 8)), **kwargs)
+
+
+def randomFrame(rng):
+    """Returns a random (arbitration ID, data) pair, which may or may not be a valid message."""
+    arbitration_id = rng.randrange(2 ** 29)
+    if rng.randrange(2):
+        # Most random IDs are unknown protocols, so steer half of them to ones with their own decoders
+        broadcast, protocol = rng.choice([
+            (False, messages.YARPMessage.PROTOCOL_NUMBER),
+            (False, messages.RAPMessage.PROTOCOL_NUMBER),
+            (False, messages.BTPMessage.PROTOCOL_NUMBER),
+            (True, messages.TelemetryMessage.PROTOCOL_NUMBER)])
+        arbitration_id = (arbitration_id & ~(0x1F << 22)) | (broadcast << 26) | (protocol << 22)
+    elif rng.randrange(25) == 0:
+        arbitration_id = rng.randrange(2 ** 29, 2 ** 32)
+    return arbitration_id, randomBytes(rng, rng.randint(0, 8))
+
+
+def decodeOrError(decoder, arbitration_id, data):
+    try:
+        return fields(decoder(arbitration_id, data))
+    except DECODE_ERRORS as e:
+        return 'IndexError' if isinstance(e, IndexError) else 'ValueError'
+
+
+class CodecEquivalenceTest(unittest.TestCase):
+    def testRoundTrip(self):
+        rng = random.Random(SEED)
+        for i in range(CORPUS_SIZE):
+            message = randomMessage(rng)
+            expected = fields(message)
+            frames = dict((name, encoder(message)) for name, encoder in ENCODERS.items())
+            for name, frame in frames.items():
+                self.assertEquals(frame, frames['reference'], "Encoder %s disagrees on %r" % (name, expected))
+
+            arbitration_id, data = frames['reference']
+            for name, decoder in DECODERS.items():
+                self.assertEquals(fields(decoder(arbitration_id, data)), expected,
+                                  "Decoder %s fails to round trip %r" % (name, expected))
+
+    def testFuzzDecode(self):
+        rng = random.Random(SEED)
+        for i in range(CORPUS_SIZE):
+            arbitration_id, data = randomFrame(rng)
+            expected = decodeOrError(referenceDecode, arbitration_id, data)
+            for name, decoder in DECODERS.items():
+                # Anything other than a decoding error propagates and fails the test
+                self.assertEquals(decodeOrError(decoder, arbitration_id, data), expected,
+                                  "Decoder %s disagrees on %08x %r" % (name, arbitration_id, data))
+
+    def testGatewayRouting(self):
+        rng = random.Random(SEED)
+        for i in range(CORPUS_SIZE):
+            arbitration_id = rng.randrange(2 ** 29)
+            try:
+                message = referenceDecode(arbitration_id, '\0' * 8)
+            except DECODE_ERRORS:
+                continue
+            self.assertEquals(gateway._sender(arbitration_id), message.sender)
+            self.assertEquals(bool(gateway._isBroadcast(arbitration_id)),
+                              isinstance(message, messages.BroadcastMessage))
+            if isinstance(message, messages.UnicastMessage):
+                self.assertEquals(gateway._recipient(arbitration_id), message.recipient)
+
+    def testBenchmark(self):
+        results = benchmark(corpus_size=20, out=None)
+        self.assertEquals(set(results), set(['decode:' + name for name in DECODERS] +
+                                            ['encode:' + name for name in ENCODERS]))
+
+
+def benchmark(corpus_size=CORPUS_SIZE, out=sys.stdout):
+    """Times every codec variant on the same corpus, returning a dict of microseconds per message."""
+    rng = random.Random(SEED)
+    corpus = [randomMessage(rng) for i in range(corpus_size)]
+    frames = [ENCODERS['reference'](message) for message in corpus]
+
+    results = {}
+    for name, encoder in sorted(ENCODERS.items()):
+        start = monotonic()
+        for message in corpus:
+            encoder(message)
+        results['encode:' + name] = (monotonic() - start) * 1e6 / corpus_size
+    for name, decoder in sorted(DECODERS.items()):
+        start = monotonic()
+        for arbitration_id, data in frames:
+            decoder(arbitration_id, data)
+        results['decode:' + name] = (monotonic() - start) * 1e6 / corpus_size
+
+    if out:
+        for name, duration in sorted(results.items()):
+            out.write("%-20s %8.2f us/message\n" % (name, duration))
+    return results
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['bench']:
+        benchmark()
+    else:
+        unittest.main()
@@ -0,0 +1,111 @@
+import time
+import unittest
+from uCAN import gateway, messages
+from uCAN.bus import _encodeMessage
+from uCAN.tests.bus import TestBus, sample_hwid
+
+
+def rap(sender, recipient):
+    return _encodeMessage(messages.RAPMessage(sender=sender, recipient=recipient, write=False, response=False,
+                                              page=0, register=0, size=1))
+
+
+class GatewayTest(unittest.TestCase):
+    def testRoute(self):
+        times = [0.0]
+        gw = gateway.Gateway([TestBus(), TestBus(), TestBus()], learn_timeout=10.0, now=lambda: times[0])
+
+        # Unknown recipients are flooded
+        self.assertEquals(gw.route(0, rap(0x20, 0x30)), [1, 2])
+        # Now we know where 0x20 is
+        self.assertEquals(gw.route(1, rap(0x30, 0x20)), [0])
+        self.assertEquals(gw.route(0, rap(0x20, 0x30)), [1])
+        # Local traffic stays local
+        self.assertEquals(gw.route(0, rap(0x21, 0x20)), [])
+        # Broadcasts go everywhere else
+        self.assertEquals(gw.route(2, _encodeMessage(messages.TelemetryMessage(sender=0x40, page=0, register=0,
+                                                                               data='a'))), [0, 1])
+        self.assertEquals(gw.route(2, rap(0x41, 0xFF)), [0, 1])
+        self.assertEquals(gw.route(2, _encodeMessage(messages.YARPMessage(
+            query=True, response=False, sender=0xFF, recipient=0xFF, hardware_id=sample_hwid))), [0, 1])
+
+        # Routes expire
+        times[0] = 11.0
+        self.assertEquals(gw.route(0, rap(0x21, 0x40)), [1, 2])
+
+    def testNodeMoves(self):
+        gw = gateway.Gateway([TestBus(), TestBus()])
+
+        # A name server on segment 0 answers on behalf of node 0x80, which is on segment 1
+        reply = _encodeMessage(messages.YARPMessage(query=True, response=True, sender=0x80, recipient=0xFF,
+                                                    hardware_id=sample_hwid))
+        self.assertEquals(gw.route(0, reply), [1])
+
+        # When 0x80 speaks for itself, its route is re-learned rather than its frames being dropped
+        self.assertEquals(gw.route(1, rap(0x80, 0x01)), [0])
+        self.assertEquals(gw.route(0, rap(0x01, 0x80)), [1])
+
+    def testLoopSuppression(self):
+        times = [0.0]
+        segments = [TestBus(), TestBus()]
+        gw = gateway.Gateway(segments, loop_window=0.1, now=lambda: times[0])
+
+        frame = rap(0x20, 0x30)
+        gw.forward(0, frame)
+        self.assertEquals(gw.forwarded, [0, 1])
+
+        # The copy we sent on segment 1 coming back is dropped, once
+        gw.forward(1, rap(0x20, 0x30))
+        self.assertEquals(gw.forwarded, [0, 1])
+
+        # Another one is a genuine new frame, heard on a new segment
+        gw.forward(1, rap(0x20, 0x30))
+        self.assertEquals(gw.forwarded, [1, 1])
+
+        # Transmitted frames are forgotten after the loop window
+        times[0] = 0.2
+        gw.forward(0, rap(0x20, 0x30))
+        self.assertEquals(gw.forwarded, [1, 2])
+
+    def testSilentSegment(self):
+        times = [0.0]
+        gw = gateway.Gateway([TestBus(), TestBus()], loop_window=0.1, now=lambda: times[0])
+
+        # Segment 1 never sends anything back, but its transmitted frames are still forgotten
+        for i in range(1000):
+            times[0] = float(i)
+            gw.forward(0, rap(i & 0x3F, 0x7F))
+            gw.queues[1].get_nowait()
+        self.assertEquals(len(gw.transmitted[1]), 1)
+        self.assertEquals(len(gw.transmitted_expiry[1]), 1)
+
+    def testForward(self):
+        segments = [TestBus(), TestBus()]
+        gw = gateway.Gateway(segments, queue_size=1)
+
+        gw.forward(0, rap(0x20, 0x30))
+        gw.forward(0, rap(0x20, 0x30))
+        self.assertEquals(gw.forwarded, [0, 1])
+        self.assertEquals(gw.dropped, [0, 1])
+
+    def testThreads(self):
+        segments = [TestBus(), TestBus()]
+        segments[0].receive_queue.append(rap(0x20, 0x30))
+        gw = gateway.Gateway(segments)
+        gw.start()
+        try:
+            deadline = time.time() + 5.0
+            while not segments[1].send_queue and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            gw.stop()
+
+        self.assertEquals(len(segments[1].send_queue), 1)
+        message = segments[1].getSentMessage()
+        self.assertEquals(message.sender, 0x20)
+        self.assertEquals(message.recipient, 0x30)
+        self.assertEquals(len(segments[0].send_queue), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
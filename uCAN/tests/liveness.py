@@ -0,0 +1,73 @@
+import unittest
+from uCAN import liveness, messages
+from uCAN.bus import Bus
+from uCAN.tests.bus import TestBus, sample_hwid, sample_hwid_2
+
+
+class NodeMonitorTest(unittest.TestCase):
+    def testPassive(self):
+        times = [0.0]
+        tb = TestBus()
+        tb.addReceivedMessages([
+            # Traffic between other nodes still counts
+            messages.RAPMessage(sender=0x20, recipient=0x30, write=False, response=False, page=0, register=0,
+                                size=1),
+            messages.TelemetryMessage(sender=0x21, page=0, register=0, data='a'),
+        ])
+        ubus = Bus(tb, sample_hwid)
+        ubus.node_id = 0x10
+
+        events = []
+        monitor = liveness.NodeMonitor(ubus, silence_timeout=5.0, now=lambda: times[0],
+                                       on_up=lambda bus, node_id: events.append(('up', node_id)),
+                                       on_down=lambda bus, node_id: events.append(('down', node_id)))
+        ubus.receive()
+        ubus.receive()
+
+        self.assertEquals(events, [('up', 0x20), ('up', 0x21)])
+        self.assertTrue(monitor.isAlive(ubus.getNodeFromNodeId(0x20)))
+        self.assertFalse(monitor.isAlive(ubus.getNodeFromNodeId(0x30)))
+        self.assertEquals(monitor.aliveNodes(), [0x20, 0x21])
+
+        # Nobody has been quiet for long, so there's nothing to ping
+        times[0] = 4.0
+        self.assertEquals(monitor.check(), [])
+        self.assertEquals(len(tb.send_queue), 0)
+
+    def testCheck(self):
+        times = [0.0]
+        tb = TestBus()
+        tb.addReceivedMessages([
+            messages.TelemetryMessage(sender=0x20, page=0, register=0, data='a'),
+            messages.TelemetryMessage(sender=0x21, page=0, register=0, data='a'),
+        ])
+        ubus = Bus(tb, sample_hwid)
+        ubus.node_id = 0x10
+
+        events = []
+        monitor = liveness.NodeMonitor(ubus, silence_timeout=5.0, now=lambda: times[0],
+                                       on_down=lambda bus, node_id: events.append(('down', node_id)))
+        ubus.receive()
+        ubus.receive()
+
+        # 0x20 answers its ping, 0x21 doesn't
+        times[0] = 10.0
+        tb.addReceivedMessages([
+            messages.YARPMessage(query=True, response=True, sender=0x20, recipient=0x10, hardware_id=sample_hwid_2),
+        ])
+
+        def tick():
+            times[0] += 0.5
+            return times[0]
+        monitor.now = tick
+        self.assertEquals(monitor.check(), [0x21])
+        self.assertEquals(events, [('down', 0x21)])
+        self.assertEquals(monitor.aliveNodes(), [0x20])
+
+        self.assertEquals(len(tb.send_queue), 2)
+        self.assertEquals(tb.getSentMessage().recipient, 0x20)
+        self.assertEquals(tb.getSentMessage().recipient, 0x21)
+
+
+if __name__ == '__main__':
+    unittest.main()
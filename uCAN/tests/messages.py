@@ -55,5 +55,77 @@ class MessagesTest(unittest.TestCase):
         self.assertEquals(rap.data, 'foo')
         self.assertEquals(rap.size, 3)
 
+    def testDecodeEncodeTelemetry(self):
+        telemetry = messages.TelemetryMessage(sender=0x12, page=3, register=42, data='foo')
+        header = bitstring.BitString(uint=0x1400C312, length=29)
+        body = bitstring.BitString('0x2a666f6f')
+
+        self.assertEquals(telemetry.encodeHeader(), header)
+        self.assertEquals(telemetry.encodeBody(), body)
+
+        telemetry = messages.Message.decode(header, body)
+        self.assert_(isinstance(telemetry, messages.TelemetryMessage))
+        self.assertEquals(telemetry.sender, 0x12)
+        self.assertEquals(telemetry.page, 3)
+        self.assertEquals(telemetry.register, 42)
+        self.assertEquals(telemetry.data, 'foo')
+
+    def testDecodeEncodeBTP(self):
+        btp = messages.BTPMessage(sender=0x12, recipient=0x34, control=False, sequence=5, data='01234567')
+        header = bitstring.BitString(uint=0x10853412, length=29)
+        body = bitstring.BitString(bytes='01234567')
+
+        self.assertEquals(btp.encodeHeader(), header)
+        self.assertEquals(btp.encodeBody(), body)
+
+        btp = messages.Message.decode(header, body)
+        self.assert_(isinstance(btp, messages.BTPMessage))
+        self.assertFalse(btp.control)
+        self.assertEquals(btp.sequence, 5)
+        self.assertEquals(btp.data, '01234567')
+
+        btp = messages.BTPMessage(sender=0x12, recipient=0x34, control=True, sequence=0,
+                                  opcode=messages.BTPMessage.BEGIN, length=4096)
+        header = bitstring.BitString(uint=0x10A03412, length=29)
+        body = bitstring.BitString('0x0000001000')
+
+        self.assertEquals(btp.encodeHeader(), header)
+        self.assertEquals(btp.encodeBody(), body)
+
+        btp = messages.Message.decode(header, body)
+        self.assertTrue(btp.control)
+        self.assertEquals(btp.opcode, messages.BTPMessage.BEGIN)
+        self.assertEquals(btp.length, 4096)
+
+    def testZeroCopyDecode(self):
+        frame = bytearray('\x00\x2afoo')
+        rap = messages.Message.decode(0x10633412, frame)
+        self.assert_(isinstance(rap.data, memoryview))
+        self.assertEquals(rap.data, 'foo')
+
+        # The data field is a view of the frame, not a copy
+        frame[2] = 'g'
+        self.assertEquals(rap.data.tobytes(), 'goo')
+
+    def testEncodeData(self):
+        for message in [
+                messages.YARPMessage(sender=0x12, recipient=0x34, query=True, response=False),
+                messages.YARPMessage(sender=0x12, recipient=0x34, query=True, response=True, hardware_id=sample_hwid),
+                messages.YARPMessage(sender=0x12, recipient=0xFF, query=False, response=False,
+                                     hardware_id=sample_hwid, new_node_id=0x56),
+                messages.RAPMessage(sender=0x12, recipient=0x34, write=True, response=False, page=1, register=2,
+                                    data='foo'),
+                messages.RAPMessage(sender=0x12, recipient=0x34, write=False, response=False, page=1, register=2,
+                                    size=4),
+                messages.TelemetryMessage(sender=0x12, page=3, register=42, data=memoryview('foo')),
+                messages.BTPMessage(sender=0x12, recipient=0x34, control=False, sequence=5,
+                                    data=memoryview('01234567')),
+                messages.BTPMessage(sender=0x12, recipient=0x34, control=True, sequence=0,
+                                    opcode=messages.BTPMessage.BEGIN, length=4096),
+                messages.BTPMessage(sender=0x12, recipient=0x34, control=True, sequence=3,
+                                    opcode=messages.BTPMessage.ACK, block_size=16)]:
+            self.assertEquals(str(bytearray(message.encodeData())), message.encodeBody().bytes)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,139 @@
+import os
+import shutil
+import tempfile
+import unittest
+from uCAN import messages, nameserver
+from uCAN.tests.bus import TestBus, sample_hwid, sample_hwid_2
+
+
+sample_hwid_3 = "\x01\x23\x45\x67\x89\xAB\xCF"
+
+
+class NameServerTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def testAssignOnQuery(self):
+        tb = TestBus()
+        tb.addReceivedMessages([
+            messages.YARPMessage(query=True, response=False, sender=0xFF, recipient=0xFF, hardware_id=sample_hwid_2),
+            messages.YARPMessage(query=True, response=False, sender=0xFF, recipient=0xFF, hardware_id=sample_hwid_2),
+            messages.YARPMessage(query=True, response=False, sender=0xFF, recipient=0xFF, hardware_id=sample_hwid_3),
+        ])
+        ns = nameserver.NameServer(tb, sample_hwid)
+        ns.start(0x01)
+        self.assertEquals(ns.node_id, 0x01)
+
+        ns.receive()
+        ns.receive()
+        ns.receive()
+
+        self.assertEquals(len(tb.send_queue), 3)
+        for node_id, hwid in [(0x80, sample_hwid_2), (0x80, sample_hwid_2), (0x81, sample_hwid_3)]:
+            message = tb.getSentMessage()
+            self.assertTrue(isinstance(message, messages.YARPMessage))
+            self.assertTrue(message.query)
+            self.assertTrue(message.response)
+            self.assertEquals(message.sender, node_id)
+            self.assertEquals(message.recipient, 0xFF)
+            self.assertEquals(message.hardware_id, hwid)
+
+    def testUnknownLookup(self):
+        tb = TestBus()
+        tb.addReceivedMessages([
+            messages.YARPMessage(query=True, response=False, sender=0x20, recipient=0xFF, hardware_id=sample_hwid_2),
+        ])
+        ns = nameserver.NameServer(tb, sample_hwid)
+        ns.start(0x01)
+
+        # Lookups from addressed nodes don't allocate anything
+        self.assertTrue(isinstance(ns._tryReceive(), messages.YARPMessage))
+        self.assertEquals(len(tb.send_queue), 0)
+        self.assertEquals(ns.node_ids, {messages.HardwareId(sample_hwid): 0x01})
+
+    def testDuplicateDetection(self):
+        tb = TestBus()
+        tb.addReceivedMessages([
+            # A ping reply to another node teaches us about 0x20
+            messages.YARPMessage(query=True, response=True, sender=0x20, recipient=0x30, hardware_id=sample_hwid_2),
+            # Then another node turns up using the same ID
+            messages.YARPMessage(query=True, response=True, sender=0x20, recipient=0x30, hardware_id=sample_hwid_3),
+        ])
+        ns = nameserver.NameServer(tb, sample_hwid)
+        ns.start(0x01)
+
+        ns.receive()
+        self.assertEquals(ns.node_ids[messages.HardwareId(sample_hwid_2)], 0x20)
+        self.assertEquals(len(tb.send_queue), 0)
+
+        ns.receive()
+        self.assertEquals(ns.node_ids[messages.HardwareId(sample_hwid_3)], 0x80)
+        self.assertEquals(len(tb.send_queue), 1)
+        message = tb.getSentMessage()
+        self.assertFalse(message.query)
+        self.assertFalse(message.response)
+        self.assertEquals(message.hardware_id, sample_hwid_3)
+        self.assertEquals(message.new_node_id, 0x80)
+
+    def testPersistence(self):
+        path = os.path.join(self.tempdir, 'nodes.json')
+
+        ns = nameserver.NameServer(TestBus(), sample_hwid, path=path)
+        ns.start()
+        self.assertEquals(ns.node_id, 0x80)
+        self.assertEquals(ns.assign(sample_hwid_2), 0x81)
+        ns.save()
+
+        ns = nameserver.NameServer(TestBus(), sample_hwid, path=path)
+        ns.start()
+        self.assertEquals(ns.node_id, 0x80)
+        self.assertEquals(ns.node_ids[messages.HardwareId(sample_hwid_2)], 0x81)
+        self.assertEquals(ns.assign(sample_hwid_3), 0x82)
+
+        ns.release(sample_hwid_2)
+        ns.save()
+        ns = nameserver.NameServer(TestBus(), sample_hwid, path=path)
+        self.assertFalse(messages.HardwareId(sample_hwid_2) in ns.node_ids)
+
+    def testSaveOffReceivePath(self):
+        path = os.path.join(self.tempdir, 'nodes.json')
+        tb = TestBus()
+        tb.addReceivedMessages([
+            messages.YARPMessage(query=True, response=False, sender=0xFF, recipient=0xFF, hardware_id=sample_hwid_2),
+        ])
+        ns = nameserver.NameServer(tb, sample_hwid, path=path)
+        ns.start()
+
+        # Allocations made while receiving are only written out by save()
+        ns.receive()
+        saved = nameserver.NameServer(TestBus(), sample_hwid, path=path)
+        self.assertFalse(messages.HardwareId(sample_hwid_2) in saved.node_ids)
+        ns.save()
+        saved = nameserver.NameServer(TestBus(), sample_hwid, path=path)
+        self.assertEquals(saved.node_ids[messages.HardwareId(sample_hwid_2)], 0x81)
+
+    def testLearnedIdsNotAllocated(self):
+        tb = TestBus()
+        tb.addReceivedMessages([
+            messages.YARPMessage(query=True, response=True, sender=0x15, recipient=0x30, hardware_id=sample_hwid_2),
+        ])
+        ns = nameserver.NameServer(tb, sample_hwid, node_ids=[0x80])
+        ns.start(0x01)
+        ns.receive()
+
+        # Moving a node off an ID it picked for itself doesn't make that ID ours to hand out
+        self.assertEquals(ns.assign(sample_hwid_2), 0x80)
+        self.assertEquals(list(ns.free_node_ids), [])
+        ns.release(sample_hwid_2)
+        self.assertEquals(list(ns.free_node_ids), [0x80])
+
+    def testNoFreeIds(self):
+        ns = nameserver.NameServer(TestBus(), sample_hwid, node_ids=[])
+        self.assertRaises(RuntimeError, ns.start)
+
+
+if __name__ == '__main__':
+    unittest.main()
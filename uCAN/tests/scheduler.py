@@ -0,0 +1,161 @@
+import unittest
+from uCAN import bus, messages, scheduler
+from uCAN.tests.bus import TestBus, sample_hwid
+
+
+class PollSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.times = [0.0]
+        self.tb = TestBus()
+        self.ubus = bus.Bus(self.tb, sample_hwid)
+        self.ubus.node_id = 0x10
+        self.poller = scheduler.PollScheduler(self.ubus, now=lambda: self.times[0])
+        self.results = []
+
+    def callback(self, bus, node_id, page, register, data):
+        self.results.append((node_id, page, register, data))
+
+    def testPlan(self):
+        node = self.ubus.getNodeFromNodeId(0x20)
+        self.poller.addPoll(node, 0, 0, 2, 1.0, self.callback)
+        self.poller.addPoll(node, 0, 1, 2, 1.0, self.callback)  # Overlapping
+        self.poller.addPoll(node, 0, 3, 4, 1.0, self.callback)  # Adjacent, but too long to merge
+        self.poller.addPoll(node, 0, 10, 1, 1.0, self.callback)  # Not adjacent
+        self.poller.addPoll(node, 1, 0, 2, 1.0, self.callback)  # Different page
+        self.poller.addPoll(node, 0, 7, 1, 0.5, self.callback)  # Different period
+        self.poller._plan()
+
+        reads = sorted((read.page, read.register, read.length, read.period, read.next_due)
+                       for read in self.poller.reads)
+        self.assertEquals(reads, [
+            (0, 0, 3, 1.0, 0.0),
+            (0, 3, 4, 1.0, 0.25),
+            (0, 7, 1, 0.5, 0.0),
+            (0, 10, 1, 1.0, 0.5),
+            (1, 0, 2, 1.0, 0.75),
+        ])
+
+        self.assertRaises(ValueError, self.poller.addPoll, node, 0, 0, 7, 1.0, self.callback)
+
+    def testPoll(self):
+        node = self.ubus.getNodeFromNodeId(0x20)
+        spec1 = self.poller.addPoll(node, 0, 4, 2, 1.0, self.callback)
+        spec2 = self.poller.addPoll(node, 0, 6, 1, 1.0, self.callback, deadline=0.5)
+
+        self.poller.step()
+        self.assertEquals(len(self.tb.send_queue), 1)
+        message = self.tb.getSentMessage()
+        self.assertTrue(isinstance(message, messages.RAPMessage))
+        self.assertFalse(message.write)
+        self.assertFalse(message.response)
+        self.assertEquals(message.recipient, 0x20)
+        self.assertEquals(message.register, 4)
+        self.assertEquals(message.size, 3)
+
+        self.times[0] = 0.1
+        self.tb.addReceivedMessages([
+            messages.RAPMessage(sender=0x20, recipient=0x10, write=False, response=True, page=0, register=4,
+                                data='abc'),
+        ])
+        self.poller.step()
+        self.assertEquals(self.results, [(0x20, 0, 4, 'ab'), (0x20, 0, 6, 'c')])
+        self.assertEquals(len(self.tb.send_queue), 0)
+
+        # Next poll goes unanswered
+        self.times[0] = 1.0
+        self.poller.step()
+        self.assertEquals(len(self.tb.send_queue), 1)
+        self.times[0] = 1.6
+        self.poller.step()
+        self.assertEquals(spec1.completed, 1)
+        self.assertEquals(spec1.missed, 0)
+        self.assertEquals(spec2.missed, 1)
+        self.assertEquals(self.poller.missed, 1)
+
+        # spec1's longer deadline runs out as the next poll is due
+        self.times[0] = 2.0
+        self.poller.step()
+        self.assertEquals(spec1.missed, 1)
+        self.assertEquals(self.poller.missed, 2)
+        self.assertEquals(len(self.tb.send_queue), 2)
+        self.assertEquals([(rate, missed) for spec, rate, missed in self.poller.stats()], [(0.5, 1), (0.5, 1)])
+
+    def testSameStartRegister(self):
+        node = self.ubus.getNodeFromNodeId(0x20)
+        spec1 = self.poller.addPoll(node, 0, 0, 2, 1.0, self.callback)
+        spec2 = self.poller.addPoll(node, 0, 0, 4, 2.0, self.callback)
+
+        self.poller.step()
+        self.assertEquals(sorted(self.tb.getSentMessage().size for i in range(2)), [2, 4])
+
+        self.times[0] = 0.1
+        self.tb.addReceivedMessages([
+            # A reply whose length matches neither read is ignored
+            messages.RAPMessage(sender=0x20, recipient=0x10, write=False, response=True, page=0, register=0,
+                                data='abc'),
+            messages.RAPMessage(sender=0x20, recipient=0x10, write=False, response=True, page=0, register=0,
+                                data='ab'),
+            messages.RAPMessage(sender=0x20, recipient=0x10, write=False, response=True, page=0, register=0,
+                                data='abcd'),
+        ])
+        for i in range(3):
+            self.poller.step()
+        self.assertEquals(self.results, [(0x20, 0, 0, 'ab'), (0x20, 0, 0, 'abcd')])
+        self.assertEquals((spec1.completed, spec1.missed), (1, 0))
+        self.assertEquals((spec2.completed, spec2.missed), (1, 0))
+
+        # The shorter period read is polled again on schedule
+        self.times[0] = 1.0
+        self.poller.step()
+        self.assertEquals(len(self.tb.send_queue), 1)
+        self.assertEquals(self.tb.getSentMessage().size, 2)
+
+    def testMaxInFlight(self):
+        timeouts = []
+        def tryReceive(timeout):
+            timeouts.append(timeout)
+        self.ubus._tryReceive = tryReceive
+
+        node = self.ubus.getNodeFromNodeId(0x20)
+        self.poller.max_in_flight = 1
+        self.poller.addPoll(node, 0, 0, 1, 1.0, self.callback)
+        self.poller.addPoll(node, 0, 4, 1, 1.0, self.callback)
+
+        self.poller.step()
+        self.assertEquals(len(self.tb.send_queue), 1)
+
+        # The second read is overdue, but can't be sent until the first times out
+        self.times[0] = 0.6
+        self.poller.step()
+        self.assertEquals(len(self.tb.send_queue), 1)
+        self.assertEquals(timeouts, [1.0, 0.4])
+
+    def testUnresponsiveNode(self):
+        node = self.ubus.getNodeFromNodeId(0x20)
+        self.poller.max_in_flight = 1
+        specs = [self.poller.addPoll(node, 0, register, 1, 1.0, self.callback) for register in (0, 10, 20)]
+
+        for i in range(60):
+            self.times[0] = i * 0.25
+            self.poller.step()
+
+        # Every read gets a turn, and those that couldn't be sent in time are still counted as missed
+        registers = [self.tb.getSentMessage().register for i in range(len(self.tb.send_queue))]
+        self.assertEquals(registers, [0, 10, 20] * 5)
+        # One poll per second for each spec, less any whose deadline hasn't yet passed
+        self.assertEquals([spec.missed for spec in specs], [14, 14, 13])
+        self.assertEquals([spec.completed for spec in specs], [0, 0, 0])
+
+    def testRunWithoutSpecs(self):
+        timeouts = []
+        def tryReceive(timeout):
+            timeouts.append(timeout)
+            self.times[0] += timeout
+        self.ubus._tryReceive = tryReceive
+
+        self.poller.run(1.0)
+        self.assertEquals(timeouts, [1.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import json
+import logging
+import StringIO
+import unittest
+from uCAN import bus, messages, tracing
+from uCAN.tests.bus import TestBus, sample_hwid
+
+
+class TracerTest(unittest.TestCase):
+    def testSpans(self):
+        tb = TestBus()
+        tb.addReceivedMessages([
+            messages.RAPMessage(sender=0x20, recipient=0x10, write=False, response=False, page=0, register=1,
+                                size=2),
+        ])
+        ubus = bus.Bus(tb, sample_hwid)
+        ubus.node_id = 0x10
+        ubus.tracer = tracing.Tracer()
+
+        def readReg(bus, page, addr):
+            return 'a'
+        ubus.configureRegisters(0, readReg, None)
+
+        ubus.receive()
+        names = [event[0] for event in ubus.tracer.events]
+        self.assertEquals(names, ['recv', 'decode', 'filter', 'handler', 'send', 'dispatch'])
+        self.assertEquals(ubus.tracer.events[3][3], {'handler': 'readReg', 'page': 0, 'register': 1})
+
+        f = StringIO.StringIO()
+        ubus.tracer.export(f)
+        trace = json.loads(f.getvalue())
+        self.assertEquals([event['name'] for event in trace['traceEvents']], names)
+        self.assertEquals(trace['traceEvents'][3]['ph'], 'X')
+
+    def testSlowHandler(self):
+        times = [0.0]
+
+        def now():
+            times[0] += 0.01
+            return times[0]
+
+        class Handler(logging.Handler):
+            def __init__(self):
+                logging.Handler.__init__(self)
+                self.records = []
+
+            def emit(self, record):
+                self.records.append(record.getMessage())
+
+        handler = Handler()
+        tracing.logger.addHandler(handler)
+        try:
+            tracer = tracing.Tracer(slow_threshold=0.005, now=now)
+            with tracer.span('handler', handler=len, page=3, register=4):
+                pass
+            with tracer.span('recv'):
+                pass
+        finally:
+            tracing.logger.removeHandler(handler)
+
+        self.assertEquals(handler.records, ['Slow register handler len for page 3 register 4 took 10.000ms'])
+
+    def testDisabled(self):
+        tb = TestBus()
+        ubus = bus.Bus(tb, sample_hwid)
+        self.assertTrue(ubus._span('recv') is tracing.NULL_SPAN)
+
+
+if __name__ == '__main__':
+    unittest.main()
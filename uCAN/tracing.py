@@ -0,0 +1,78 @@
+import collections
+import json
+import logging
+from uCAN.clock import monotonic
+
+logger = logging.getLogger(__name__)
+
+
+class _NullSpan(object):
+    """A span that does nothing, used when tracing is turned off."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    __slots__ = ('tracer', 'name', 'args', 'start')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = self.tracer.now()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer.record(self.name, self.start, self.tracer.now() - self.start, self.args)
+        return False
+
+
+class Tracer(object):
+    """Records how long a Bus spends on each stage of sending and receiving messages.
+
+    Attach a tracer to a bus by setting its tracer attribute. Spans are recorded for recv (waiting for a
+    frame from the interface), decode, filter (observers and recipient filtering), dispatch (protocol
+    handlers), handler (RAP register handlers) and send.
+    """
+    def __init__(self, slow_threshold=None, max_events=100000, now=monotonic):
+        """Constructs a tracer.
+
+        Arguments:
+          slow_threshold: If not None, register handlers taking longer than this many seconds are logged.
+          max_events: The number of most recent spans to keep.
+        """
+        self.slow_threshold = slow_threshold
+        self.events = collections.deque(maxlen=max_events)
+        self.now = now
+
+    def span(self, name, **args):
+        """Returns a context manager that records the time spent inside it as a span."""
+        if 'handler' in args:
+            handler = args['handler']
+            args['handler'] = getattr(handler, '__name__', repr(handler))
+        return _Span(self, name, args)
+
+    def record(self, name, start, duration, args):
+        self.events.append((name, start, duration, args))
+        if name == 'handler' and self.slow_threshold is not None and duration > self.slow_threshold:
+            logger.warning("Slow register handler %s for page %d register %d took %.3fms",
+                           args.get('handler'), args.get('page'), args.get('register'), duration * 1000)
+
+    def export(self, f):
+        """Writes the recorded spans to a file object in Chrome trace event format."""
+        json.dump({'traceEvents': [{
+            'name': name,
+            'ph': 'X',
+            'ts': start * 1e6,
+            'dur': duration * 1e6,
+            'pid': 0,
+            'tid': 0,
+            'args': args,
+        } for name, start, duration, args in self.events]}, f)